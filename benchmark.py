@@ -0,0 +1,563 @@
+"""
+Benchmark sin conexión del bot completo.
+
+Levanta en local un servidor falso de la Bot API y otro de contenido (videos e
+imágenes sintéticas), y lanza links contra los handlers reales (handle_link,
+download_video, process_album, process_instagram). yt-dlp baja los videos locales
+con el extractor genérico y TikTokApi se sustituye por un stub. Muestra
+rendimiento, latencias p50/p95/p99 y pico de memoria. Al final arranca
+`bot.py` en frío contra la API falsa y mide cuánto tarda en estar listo.
+
+    python benchmark.py --requests 200 --concurrency 20
+    python benchmark.py --json bench.json --baseline main.json   # falla si empeora
+"""
+import argparse
+import asyncio
+import email
+import email.policy
+import io
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BENCH_TOKEN = "123456:BENCHMARK"
+
+
+# ---------- SERVIDOR DE CONTENIDO ----------
+
+def make_images(count):
+    """JPEG distintos entre sí (ruido); bytes aleatorios si no hay Pillow"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return [os.urandom(300 * 1024) for _ in range(count)]
+    images = []
+    for _ in range(count):
+        out = io.BytesIO()
+        Image.effect_noise((1080, 1350), random.randint(32, 96)).convert("RGB").save(out, "JPEG", quality=85)
+        images.append(out.getvalue())
+    return images
+
+
+class MediaServer(ThreadingHTTPServer):
+    """Sirve /video/<id>.mp4 (con Range, como un CDN) y /img/<post>/<n>.jpg"""
+
+    daemon_threads = True
+
+    def __init__(self, video_size, album_size):
+        super().__init__(("127.0.0.1", 0), MediaHandler)
+        self.video = os.urandom(video_size)
+        self.images = make_images(album_size)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        if self.path.startswith("/video/"):
+            body, ctype = self.server.video, "video/mp4"
+        elif self.path.startswith("/img/"):
+            idx = int(re.search(r"/(\d+)\.jpg", self.path).group(1))
+            body, ctype = self.server.images[idx % len(self.server.images)], "image/jpeg"
+        else:
+            self.send_error(404)
+            return
+
+        start, end = 0, len(body) - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body[start:end + 1])
+
+
+# ---------- BOT API FALSA ----------
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """
+    Responde a los métodos que usa el bot con mensajes verosímiles, guarda el
+    último teclado enviado a cada chat y cuenta lo que se sube
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), BotAPIHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.keyboards = {}  # chat_id -> (message_id, botones)
+        self.media = {}  # chat_id -> archivos recibidos
+        self.uploaded_bytes = 0
+        self.calls = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def message(self, chat_id, **extra):
+        return {
+            "message_id": next(self.ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    def file(self, kind):
+        n = next(self.ids)
+        return {"file_id": f"bench-{kind}-{n}", "file_unique_id": f"u{n}"}
+
+
+def parse_fields(headers, body):
+    """Parámetros de la petición y bytes de archivo subidos (multipart o formulario)"""
+    ctype = headers.get("Content-Type", "")
+    if ctype.startswith("multipart/form-data"):
+        msg = email.message_from_bytes(
+            f"Content-Type: {ctype}\r\n\r\n".encode() + body, policy=email.policy.default
+        )
+        fields, uploaded = {}, 0
+        for part in msg.iter_parts():
+            payload = part.get_payload(decode=True) or b""
+            if part.get_filename():
+                uploaded += len(payload)
+            else:
+                fields[part.get_param("name", header="content-disposition")] = payload.decode()
+        return fields, uploaded
+    if ctype.startswith("application/json"):
+        return {k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(body or b"{}").items()}, 0
+    return {k: v[0] for k, v in parse_qs(body.decode()).items()}, 0
+
+
+def local_file_size(value):
+    """Con servidor local, los archivos llegan como file://ruta y el servidor los lee"""
+    if value and value.startswith("file://"):
+        with open(value[len("file://"):], "rb") as f:
+            return len(f.read())
+    return 0
+
+
+class BotAPIHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        api = self.server
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        fields, uploaded = parse_fields(self.headers, body)
+        if api.latency:
+            time.sleep(api.latency)
+
+        chat_id = fields.get("chat_id", "0")
+        with api.lock:
+            api.calls += 1
+            result = self.call(api, method, fields, chat_id)
+            if method in ("sendVideo", "sendPhoto", "sendMediaGroup"):
+                for key in ("video", "photo"):
+                    uploaded += local_file_size(fields.get(key))
+                for item in json.loads(fields.get("media", "[]")):
+                    uploaded += local_file_size(item.get("media"))
+                api.uploaded_bytes += uploaded
+
+        out = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def call(self, api, method, fields, chat_id):
+        if method == "getUpdates":
+            # Nunca hay mensajes nuevos; una pausa corta en lugar del long polling
+            time.sleep(0.2)
+            return []
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in ("sendMessage", "editMessageText"):
+            message = api.message(chat_id, text=fields.get("text", ""))
+            if method == "editMessageText":
+                message["message_id"] = int(fields["message_id"])
+            if "reply_markup" in fields:
+                markup = json.loads(fields["reply_markup"])
+                message["reply_markup"] = markup
+                buttons = [b["callback_data"] for row in markup["inline_keyboard"] for b in row]
+                api.keyboards[int(chat_id)] = (message["message_id"], buttons)
+            return message
+        if method == "sendVideo":
+            api.media.setdefault(int(chat_id), []).append("video")
+            return api.message(chat_id, video={**api.file("video"), "width": 1280, "height": 720, "duration": 10})
+        if method == "sendPhoto":
+            api.media.setdefault(int(chat_id), []).append("photo")
+            return api.message(chat_id, photo=[{**api.file("photo"), "width": 1080, "height": 1350}])
+        if method == "sendMediaGroup":
+            items = json.loads(fields.get("media", "[]"))
+            api.media.setdefault(int(chat_id), []).extend("photo" for _ in items)
+            return [
+                api.message(chat_id, photo=[{**api.file("photo"), "width": 1080, "height": 1350}])
+                for _ in items
+            ]
+        # deleteMessage, answerCallbackQuery, setWebhook...
+        return True
+
+
+# ---------- STUBS ----------
+
+def install_tiktok_stub(media_url, album_size):
+    """Sustituye el paquete TikTokApi: los álbumes apuntan al servidor de contenido"""
+
+    class Page:
+        async def evaluate(self, script):
+            return True
+
+    class Video:
+        def __init__(self, url):
+            self.post_id = re.search(r"/photo/(\d+)", url).group(1)
+
+        async def info(self):
+            return {"imagePost": {"images": [
+                {"imageURL": {"urlList": [f"{media_url}/img/{self.post_id}/{idx}.jpg"]}}
+                for idx in range(album_size)
+            ]}}
+
+    class TikTokApi:
+        def __init__(self):
+            self.sessions = []
+
+        async def create_sessions(self, **kwargs):
+            self.sessions = [types.SimpleNamespace(page=Page())]
+
+        async def close_sessions(self):
+            self.sessions = []
+
+        async def stop_playwright(self):
+            pass
+
+        def video(self, url):
+            return Video(url)
+
+    module = types.ModuleType("TikTokApi")
+    module.TikTokApi = TikTokApi
+    sys.modules["TikTokApi"] = module
+
+
+# Links de las plataformas -> video local (extractor genérico de yt-dlp)
+LOCAL_ROUTES = [
+    re.compile(r"youtube\.com/watch\?v=([\w-]+)"),
+    re.compile(r"instagram\.com/reel/([\w-]+)"),
+]
+
+
+def install_ytdlp_redirect(media_url):
+    import yt_dlp
+
+    class LocalYoutubeDL(yt_dlp.YoutubeDL):
+        def extract_info(self, url, *args, **kwargs):
+            for pattern in LOCAL_ROUTES:
+                match = pattern.search(url)
+                if match:
+                    url = f"{media_url}/video/{match.group(1)}.mp4"
+                    break
+            return super().extract_info(url, *args, **kwargs)
+
+    yt_dlp.YoutubeDL = LocalYoutubeDL
+
+
+# ---------- CARGA ----------
+
+def make_url(kind, content_id):
+    if kind == "video":
+        return f"https://www.youtube.com/watch?v=bench{content_id:06d}"
+    if kind == "album":
+        return f"https://www.tiktok.com/@bench/photo/{7000000000000000000 + content_id}"
+    return f"https://www.instagram.com/reel/Bench{content_id:06d}/"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+async def run_load(args, api, app, bot_module):
+    from telegram import Update
+    from telegram.ext import CallbackContext
+
+    weights = dict(item.split("=") for item in args.mix.split(","))
+    kinds = random.Random(args.seed).choices(
+        list(weights), weights=[float(w) for w in weights.values()], k=args.requests
+    )
+    distinct = args.distinct or args.requests
+    update_ids = itertools.count(1)
+    queue = asyncio.Queue()
+    for i, kind in enumerate(kinds):
+        queue.put_nowait((i, kind))
+    results = []
+
+    def user(uid):
+        return {"id": uid, "is_bot": False, "first_name": "Bench", "username": f"bench{uid}"}
+
+    async def dispatch(handler, data):
+        update = Update.de_json(data, app.bot)
+        await handler(update, CallbackContext.from_update(update, app))
+
+    async def one(i, kind):
+        chat_id = 100000 + i
+        uid = 1000 + i % args.users
+        url = make_url(kind, i % distinct)
+        await dispatch(bot_module.handle_link, {
+            "update_id": next(update_ids),
+            "message": {
+                "message_id": next(api.ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": user(uid), "text": url,
+            },
+        })
+        if kind == "video":
+            # Pulsar la primera calidad ofrecida
+            message_id, buttons = api.keyboards[chat_id]
+            await dispatch(bot_module.download_video, {
+                "update_id": next(update_ids),
+                "callback_query": {
+                    "id": str(i), "from": user(uid), "chat_instance": "bench", "data": buttons[0],
+                    "message": {
+                        "message_id": message_id, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"}, "text": "",
+                    },
+                },
+            })
+        return bool(api.media.get(chat_id))
+
+    async def worker():
+        while not queue.empty():
+            i, kind = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                ok = await one(i, kind)
+            except Exception as e:
+                print(f"Petición {i} ({kind}) falló: {e}")
+                ok = False
+            results.append((kind, time.perf_counter() - start, ok))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed, api):
+    def stats(rows):
+        latencies = [latency for _, latency, ok in rows if ok]
+        return {
+            "requests": len(rows),
+            "ok": len(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        }
+
+    report = {
+        "elapsed": elapsed,
+        "throughput": sum(1 for *_, ok in results if ok) / elapsed,
+        **stats(results),
+        "by_kind": {kind: stats([r for r in results if r[0] == kind]) for kind in sorted({r[0] for r in results})},
+        "uploaded_mb": api.uploaded_bytes / (1024 * 1024),
+        "api_calls": api.calls,
+        # ru_maxrss está en KB en Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+    return report
+
+
+def print_report(report):
+    print(f"\n{'tipo':<10} {'ok':>9} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+    for kind, s in [*report["by_kind"].items(), ("total", report)]:
+        print(f"{kind:<10} {s['ok']:>4}/{s['requests']:<4} {s['p50']:>8.2f} {s['p95']:>8.2f} {s['p99']:>8.2f}")
+    print(
+        f"\n⏱  {report['elapsed']:.1f} s · {report['throughput']:.2f} peticiones/s · "
+        f"{report['uploaded_mb']:.0f} MB subidos · {report['api_calls']} llamadas a la API"
+    )
+    print(f"🧠 Pico RSS: {report['peak_rss_mb']:.0f} MB (hijos: {report['peak_rss_children_mb']:.0f} MB)")
+    if "startup" in report:
+        startup = report["startup"]
+        print(f"🚀 Arranque hasta estar listo: {startup['p50']:.2f} s (máx. {startup['max']:.2f} s, {startup['runs']} veces)")
+
+
+def check_regression(report, baseline_path, tolerance):
+    """Compara con una ejecución anterior; devuelve los problemas encontrados"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    problems = []
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        problems.append(f"rendimiento {report['throughput']:.2f} < {baseline['throughput']:.2f} peticiones/s")
+    for key in ("p95", "p99"):
+        if report[key] > baseline[key] * (1 + tolerance):
+            problems.append(f"{key} {report[key]:.2f} s > {baseline[key]:.2f} s")
+    if "startup" in report and "startup" in baseline:
+        if report["startup"]["p50"] > baseline["startup"]["p50"] * (1 + tolerance):
+            problems.append(f"arranque {report['startup']['p50']:.2f} s > {baseline['startup']['p50']:.2f} s")
+    if report["ok"] < report["requests"]:
+        problems.append(f"{report['requests'] - report['ok']} peticiones fallidas")
+    return problems
+
+
+def measure_startup(api, runs, tmp):
+    """
+    Lanza `python bot.py` contra la API falsa y mide cuánto tarda en crear
+    READY_FILE (intérprete, imports y post_init incluidos), sin precalentar
+    """
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    times = []
+    for i in range(runs):
+        ready_file = os.path.join(tmp, f"ready-{i}")
+        env = {
+            **os.environ,
+            "BOT_API_SERVER": api.url,
+            "BOT_API_LOCAL_MODE": "false",
+            "READY_FILE": ready_file,
+            "WARMUP_BACKENDS": "false",
+        }
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, bot_path], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            while not os.path.exists(ready_file):
+                if proc.poll() is not None:
+                    raise RuntimeError(f"bot.py terminó durante el arranque (código {proc.returncode})")
+                if time.perf_counter() - start > 60:
+                    raise RuntimeError("bot.py no estuvo listo en 60 s")
+                time.sleep(0.01)
+            times.append(time.perf_counter() - start)
+        finally:
+            # Como un Ctrl+C: parada ordenada (post_shutdown borra READY_FILE)
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+    return {"runs": runs, "p50": percentile(times, 50), "max": max(times)}
+
+
+async def main_async(args, api, media):
+    import bot
+    from telegram.ext import ApplicationBuilder
+    from database import init_db, close_db
+    from http_client import close_client
+    from tiktok_pool import tiktok_pool
+    from workspace import workspace
+
+    app = (
+        ApplicationBuilder()
+        .token(BENCH_TOKEN)
+        .concurrent_updates(True)
+        .base_url(f"{api.url}/bot")
+        .base_file_url(f"{api.url}/file/bot")
+        .local_mode(args.local_mode)
+        .build()
+    )
+    await app.initialize()
+    await init_db()
+    await workspace.start()
+    try:
+        results, elapsed = await run_load(args, api, app, bot)
+    finally:
+        await close_db()
+        await workspace.stop()
+        await tiktok_pool.stop()
+        await close_client()
+        await app.shutdown()
+    return summarize(results, elapsed, api)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del bot contra servicios locales")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--users", type=int, default=20, help="usuarios distintos (límite por usuario de la cola)")
+    parser.add_argument("--mix", default="video=6,album=2,instagram=2", help="peso de cada tipo de link")
+    parser.add_argument("--distinct", type=int, default=0, help="contenidos distintos (0 = todos distintos, sin caché)")
+    parser.add_argument("--video-mb", type=float, default=5)
+    parser.add_argument("--album-size", type=int, default=10)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="segundos de espera por llamada a la API falsa")
+    parser.add_argument("--local-mode", action="store_true", help="subidas por ruta, como con servidor propio de la Bot API")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="guardar el resultado en este archivo")
+    parser.add_argument("--baseline", help="resultado anterior (--json) con el que comparar")
+    parser.add_argument("--startup-runs", type=int, default=3, help="arranques en frío medidos (0 = no medir)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="empeoramiento permitido frente a --baseline")
+    args = parser.parse_args()
+
+    media = MediaServer(int(args.video_mb * 1024 * 1024), args.album_size)
+    api = FakeBotAPI(args.api_latency)
+    for server in (media, api):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Todo el estado del bot en una carpeta temporal, sin tocar la instalación real
+    tmp = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "DB_PATH": os.path.join(tmp, "bench.db"),
+        "WORKSPACE_DIR": os.path.join(tmp, "media"),
+        "METRICS_PORT": "0",
+        "WEBHOOK_URL": "",
+        "BOT_API_LOCAL_MODE": "true" if args.local_mode else "false",
+        # Los servidores falsos no limitan: que el limitador de plataformas no frene la carga
+        "YOUTUBE_RATE": "1000", "TIKTOK_RATE": "1000", "INSTAGRAM_RATE": "1000", "UPSTREAM_BURST": "1000",
+    })
+    install_tiktok_stub(media.url, args.album_size)
+    install_ytdlp_redirect(media.url)
+
+    report = asyncio.run(main_async(args, api, media))
+    # Después de la carga, para que no cuente en el pico de memoria de los hijos
+    if args.startup_runs:
+        report["startup"] = measure_startup(api, args.startup_runs, tmp)
+    report["args"] = vars(args)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        problems = check_regression(report, args.baseline, args.tolerance)
+        for problem in problems:
+            print(f"❌ Regresión: {problem}")
+        if problems:
+            sys.exit(1)
+        print("✅ Sin regresiones frente a la referencia")
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
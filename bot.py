@@ -3,18 +3,41 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     CallbackQueryHandler, ContextTypes, filters
 )
+from telegram.error import RetryAfter
+import asyncio
+import importlib
 import os
-from config import TOKEN
-from downloader import download
-from database import init_db, save_download, get_user_stats
-
-init_db()
+import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from config import (
+    TOKEN, BOT_API_SERVER, BOT_API_LOCAL_MODE, PROGRESS_EDIT_INTERVAL, METRICS_PORT, METRICS_ADDR,
+    MAX_BATCH_LINKS, MAX_BATCH_FILE_SIZE, WARMUP_BACKENDS, READY_FILE, ADMIN_IDS, TOP_URLS_RETENTION_DAYS,
+    TOP_URLS_WINDOWS,
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+)
+from downloader import (
+    download, download_stream, release_file, detect_platform, make_cache_key, probe, format_options
+)
+from scheduler import scheduler, QueueFullError
+from ratelimit import upstream, UpstreamUnavailable
+from http_client import close_client
+from browser_pool import browser_pool
+from tiktok_pool import tiktok_pool
+from state_store import state_store
+from workspace import workspace
+from url_router import route
+from metrics import timed, error, start_metrics_server, UPLOADED_BYTES, READY, STARTUP_SECONDS
+from database import (
+    init_db, close_db, save_download, get_user_stats, get_cached_media, save_cached_media,
+    get_platform_stats, get_top_urls
+)
 
 # ---------- COMANDOS ----------
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    stats = get_user_stats(user.id)
+    stats = await get_user_stats(user.id)
     
     welcome_text = (
         f"👋 ¡Hola {user.first_name}!\n\n"
@@ -40,7 +63,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    total = get_user_stats(user.id)
+    total = await get_user_stats(user.id)
     
     await update.message.reply_text(
         f"📊 *Tus Estadísticas*\n\n"
@@ -67,20 +90,274 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "2️⃣ Envíamelo por aquí\n"
         "3️⃣ Elige la calidad (si es video)\n"
         "4️⃣ ¡Descarga lista!\n\n"
+        "📦 *Varios links:* envíalos juntos en un mensaje o en un archivo .txt\n\n"
         "✨ Todo sin marcas de agua"
     )
     
     await update.message.reply_text(help_text, parse_mode="Markdown")
 
 
+# ---------- ADMINISTRACIÓN ----------
+
+def is_admin(update):
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
+
+def window_days(context, default=7, maximum=365):
+    """Días pedidos en el comando (/top 30), entre 1 y maximum"""
+    try:
+        days = int(context.args[0]) if context.args else default
+    except ValueError:
+        days = default
+    return max(1, min(days, maximum))
+
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/top [días]: links más descargados (desde el ranking precalculado, sin tocar el historial)"""
+    if not is_admin(update):
+        return
+    # La menor ventana mantenida que cubra los días pedidos
+    days = window_days(context, maximum=TOP_URLS_RETENTION_DAYS)
+    days = next(window for window in TOP_URLS_WINDOWS if window >= days)
+    rows = await get_top_urls(days)
+
+    if not rows:
+        await update.message.reply_text(f"🏆 Sin descargas en los últimos {days} días")
+        return
+
+    lines = [f"🏆 *Más descargados ({days} días)*", ""]
+    for idx, (url, platform, total) in enumerate(rows, 1):
+        lines.append(f"{idx}. *{total}* · {platform} · `{url}`")
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown", disable_web_page_preview=True)
+
+
+async def platforms_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/platforms [días]: descargas por plataforma y tipo (desde daily_stats)"""
+    if not is_admin(update):
+        return
+    days = window_days(context)
+    rows = await get_platform_stats(days)
+
+    by_platform = {}
+    for platform, content_type, total in rows:
+        by_platform.setdefault(platform or "Otros", {})[content_type or "?"] = total
+
+    lines = [f"📊 *Descargas por plataforma ({days} días)*", ""]
+    for platform, types in sorted(by_platform.items(), key=lambda item: -sum(item[1].values())):
+        detail = " · ".join(f"{content_type} {total}" for content_type, total in sorted(types.items()))
+        lines.append(f"*{platform}*: {sum(types.values())} ({detail})")
+    lines.append("")
+    lines.append(f"Total: *{sum(total for *_, total in rows)}*")
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+
+# ---------- CACHÉ DE ARCHIVOS ----------
+
+def sent_file_id(sent):
+    """Extrae el file_id que Telegram asignó a un mensaje enviado por el bot"""
+    if sent.video:
+        return {"type": "video", "file_id": sent.video.file_id}
+    if sent.photo:
+        # La última resolución es la original
+        return {"type": "photo", "file_id": sent.photo[-1].file_id}
+    return None
+
+
+async def reply_media(message, media, caption=None):
+    """
+    Envía hasta 10 elementos (tipo, file_id o archivo) como media group, o
+    como mensaje suelto si es uno solo. caption va en el primer elemento.
+    Devuelve los mensajes enviados
+    """
+    if len(media) == 1:
+        # Un media group necesita al menos 2 elementos
+        kind, source = media[0]
+        if kind == "video":
+            return [await message.reply_video(
+                video=source, caption=caption, parse_mode="Markdown", supports_streaming=True
+            )]
+        return [await message.reply_photo(photo=source, caption=caption, parse_mode="Markdown")]
+    return await message.reply_media_group([
+        InputMediaVideo(
+            media=source, caption=caption if idx == 0 else None,
+            parse_mode="Markdown", supports_streaming=True
+        ) if kind == "video"
+        else InputMediaPhoto(media=source, caption=caption if idx == 0 else None, parse_mode="Markdown")
+        for idx, (kind, source) in enumerate(media)
+    ])
+
+
+async def send_cached_media(message, items, platform):
+    """Reenvía contenido ya subido usando sus file_id (sin descarga ni subida)"""
+    media = [(item["type"], item["file_id"]) for item in items]
+    # Como en la primera descarga, solo se indica la plataforma si hay video
+    caption = f"✅ Descargado de *{platform}*" if any(kind == "video" for kind, _ in media) else None
+
+    # Enviar en grupos de 10 (límite de Telegram), en el orden original
+    for i in range(0, len(media), 10):
+        await reply_media(message, media[i:i+10], caption if i == 0 else None)
+
+
+# ---------- COLA DE DESCARGAS ----------
+
+def queue_feedback(status_msg, reply_markup=None):
+    """Callback que muestra la posición en la cola en el mensaje de estado"""
+    async def on_position(position):
+        if position == 0:
+            await status_msg.edit_text(
+                "⏳ *Descargando...*\n\n"
+                "Por favor espera, esto puede tardar un momento",
+                reply_markup=reply_markup,
+                parse_mode="Markdown"
+            )
+            return
+        await status_msg.edit_text(
+            f"🕒 *En cola*\n\n"
+            f"Posición: *{position}*\n"
+            "Tu descarga empezará en cuanto haya un hueco libre",
+            reply_markup=reply_markup,
+            parse_mode="Markdown"
+        )
+    return on_position
+
+
+async def queue_full(status_msg):
+    await status_msg.edit_text(
+        "🚦 *Bot saturado*\n\n"
+        "Hay demasiadas descargas en curso ahora mismo.\n"
+        "Vuelve a intentarlo en unos minutos",
+        parse_mode="Markdown"
+    )
+
+
+def unavailable_text(platform, retry_after):
+    minutes = max(1, round(retry_after / 60))
+    return (
+        f"⏸️ *{platform} está limitando las descargas*\n\n"
+        "Para no empeorarlo, el bot deja de pedirle contenido un rato.\n"
+        f"Vuelve a intentarlo en ~{minutes} min"
+    )
+
+
+async def upstream_unavailable(status_msg, e):
+    await status_msg.edit_text(unavailable_text(e.platform, e.retry_after), parse_mode="Markdown")
+
+
+# ---------- PROGRESO ----------
+
+MB = 1024 * 1024
+
+# Descargas en curso en esta instancia: token -> tarea (para el botón de cancelar)
+active_downloads = {}
+# Tokens cuya descarga se detuvo con el botón (y no por cancelar el handler)
+stopped_downloads = set()
+
+
+def progress_text(progress):
+    """Barra, tamaño, velocidad y tiempo restante de una descarga"""
+    lines = ["⏳ *Descargando video...*", ""]
+    downloaded, total = progress["downloaded"], progress["total"]
+    if total:
+        ratio = min(downloaded / total, 1)
+        filled = int(ratio * 10)
+        lines.append(f"{'█' * filled}{'░' * (10 - filled)} {ratio:.0%}")
+        lines.append(f"📦 {downloaded / MB:.1f} / {total / MB:.1f} MB")
+    else:
+        lines.append(f"📦 {downloaded / MB:.1f} MB")
+    if progress["speed"]:
+        lines.append(f"🚀 {progress['speed'] / MB:.1f} MB/s")
+    if progress["eta"] is not None:
+        minutes, seconds = divmod(int(progress["eta"]), 60)
+        lines.append(f"⏱ {minutes}:{seconds:02d} restantes")
+    return "\n".join(lines)
+
+
+class ProgressEditor:
+    """
+    Muestra el progreso en el mensaje de estado. Como mucho una edición cada
+    PROGRESS_EDIT_INTERVAL segundos (Telegram limita las ediciones): los avisos
+    que llegan entre medias se agrupan y solo se muestra el último
+    """
+
+    def __init__(self, message, reply_markup=None, interval=PROGRESS_EDIT_INTERVAL, render=progress_text):
+        self.message = message
+        self.reply_markup = reply_markup
+        self.interval = interval
+        self.render = render
+        self.latest = None
+        self.last_edit = 0
+        self.task = None
+        self.closed = False
+
+    def update(self, progress):
+        self.latest = progress
+        if self.task is None and not self.closed:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self.latest is not None and not self.closed:
+                delay = self.last_edit + self.interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                progress, self.latest = self.latest, None
+                self.last_edit = time.monotonic()
+                try:
+                    await self.message.edit_text(
+                        self.render(progress),
+                        reply_markup=self.reply_markup,
+                        parse_mode="Markdown"
+                    )
+                except RetryAfter as e:
+                    self.last_edit = time.monotonic() + e.retry_after
+                except Exception:
+                    # p. ej. "message is not modified"
+                    pass
+        finally:
+            self.task = None
+
+    def close(self):
+        """Deja de editar (el mensaje pasa a otro estado)"""
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+
+
+async def watch_cancel(token, task):
+    """Con varias instancias, el botón puede llegar a otra: revisar si pidió cancelar"""
+    while not task.done():
+        await asyncio.sleep(PROGRESS_EDIT_INTERVAL)
+        if await state_store.cancel_requested(token):
+            stopped_downloads.add(token)
+            task.cancel()
+            return
+
+
 # ---------- MANEJO DE LINKS ----------
 
 async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    url = update.message.text.strip()
-    
-    # Validar URL
-    supported_domains = ["tiktok.com", "instagram.com", "youtube.com", "youtu.be"]
-    if not any(domain in url for domain in supported_domains):
+    # Validar y clasificar los links del mensaje (los enlaces cortos se resuelven)
+    with timed("validation"):
+        links = await route(update.message.text)
+    await process_links(update, context, links)
+
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Un .txt con links (uno o varios por línea) se procesa como un lote"""
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_BATCH_FILE_SIZE:
+        await update.message.reply_text("❌ El archivo es demasiado grande")
+        return
+
+    file = await document.get_file()
+    text = (await file.download_as_bytearray()).decode("utf-8", errors="ignore")
+    with timed("validation"):
+        links = await route(text)
+    await process_links(update, context, links)
+
+
+async def process_links(update: Update, context: ContextTypes.DEFAULT_TYPE, links):
+    if not links:
         await update.message.reply_text(
             "❌ *URL no soportada*\n\n"
             "Plataformas válidas:\n"
@@ -91,44 +368,95 @@ async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
         return
-    
-    context.user_data["url"] = url
+
+    if len(links) == 1:
+        await process_link(update, context, links[0])
+        return
+
+    if len(links) > MAX_BATCH_LINKS:
+        await update.message.reply_text(
+            f"⚠️ Solo se procesan los primeros *{MAX_BATCH_LINKS}* links del mensaje",
+            parse_mode="Markdown"
+        )
+        links = links[:MAX_BATCH_LINKS]
+    await process_batch(update, links)
+
+
+async def process_link(update: Update, context: ContextTypes.DEFAULT_TYPE, link):
+    url = link.url
+
+    # Plataforma con el circuito abierto: avisar sin sondear ni encolar nada
+    if not upstream.available(link.platform):
+        await update.message.reply_text(
+            unavailable_text(link.platform, upstream.retry_after(link.platform)),
+            parse_mode="Markdown"
+        )
+        return
 
     # 🟣 TikTok álbum (photo/slideshow)
-    if "tiktok.com" in url and "/photo/" in url:
+    if link.kind == "album":
         msg = await update.message.reply_text(
             "📸 *Álbum de TikTok detectado*\n\n"
             "⏳ Descargando imágenes...\n"
             "Esto puede tardar unos segundos",
             parse_mode="Markdown"
         )
-        context.user_data["status_msg"] = msg
-        await process_album(update, context)
+        await process_album(update, context, url, msg)
         return
     
-    # 🟠 Instagram posts/álbumes
-    if "instagram.com" in url and ("/p/" in url or "/reel/" in url):
+    # 🟠 Instagram posts/álbumes/reels
+    if link.platform == "Instagram":
         msg = await update.message.reply_text(
             "📸 *Instagram detectado*\n\n"
             "⏳ Procesando contenido...",
             parse_mode="Markdown"
         )
-        context.user_data["status_msg"] = msg
-        await process_instagram(update, context)
+        await process_instagram(update, context, url, msg)
+        return
+
+    # 🟢 Videos (TikTok video / YouTube): sondear formatos mientras se avisa al usuario
+    msg, options = await asyncio.gather(
+        update.message.reply_text("🔎 *Analizando video...*", parse_mode="Markdown"),
+        probe_options(url)
+    )
+
+    # La URL y las calidades se guardan en el almacén compartido; el botón solo
+    # lleva un token, así cualquier instancia del bot puede atender la elección
+    token = await state_store.put({
+        "url": url,
+        "formats": [f"fmt:{spec}" for height, spec, size in options],
+    })
+
+    if options:
+        # Solo calidades reales que Telegram acepta, con su tamaño estimado
+        keyboard = [
+            [InlineKeyboardButton(
+                f"🎥 {height}p · ~{size / (1024 * 1024):.0f} MB",
+                callback_data=f"{token}:{idx}"
+            )]
+            for idx, (height, spec, size) in enumerate(options)
+        ]
+        keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data=f"{token}:cancel")])
+
+        await msg.edit_text(
+            "🎬 *Elige la calidad del video:*\n\n"
+            "Solo se muestran las calidades que caben en Telegram",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode="Markdown"
+        )
         return
 
-    # 🟢 Videos (TikTok video / YouTube)
     keyboard = [
         [
-            InlineKeyboardButton("🎥 Alta Calidad (HD)", callback_data="best"),
-            InlineKeyboardButton("📱 Calidad Media", callback_data="medium")
+            InlineKeyboardButton("🎥 Alta Calidad (HD)", callback_data=f"{token}:best"),
+            InlineKeyboardButton("📱 Calidad Media", callback_data=f"{token}:medium")
         ],
         [
-            InlineKeyboardButton("❌ Cancelar", callback_data="cancel")
+            InlineKeyboardButton("❌ Cancelar", callback_data=f"{token}:cancel")
         ]
     ]
 
-    await update.message.reply_text(
+    await msg.edit_text(
         "🎬 *Elige la calidad del video:*\n\n"
         "🎥 *Alta:* Mejor calidad, archivo más pesado\n"
         "📱 *Media:* Buena calidad, archivo ligero",
@@ -137,73 +465,170 @@ async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def probe_options(url):
+    """Calidades disponibles para la URL, o [] si no se pudieron sondear"""
+    try:
+        info = await probe(url)
+        return format_options(info) if info else []
+    except Exception as e:
+        print(f"Error sondeando formatos: {e}")
+        return []
+
+
 # ---------- DESCARGA DE VIDEOS ----------
 
 async def download_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    if query.data == "cancel":
+    token, _, choice = query.data.partition(":")
+
+    if choice == "cancel":
+        await state_store.discard(token)
         await query.message.edit_text("❌ Descarga cancelada")
         return
 
-    url = context.user_data.get("url")
-    quality = query.data
+    if choice == "stop":
+        # Descarga ya en marcha: detenerla aquí o avisar a la instancia que la tiene
+        task = active_downloads.get(token)
+        if task is not None:
+            stopped_downloads.add(token)
+            task.cancel()
+        else:
+            await state_store.request_cancel(token)
+        return
 
+    # Solo una instancia (y una pulsación) se queda con la petición
+    pending = await state_store.claim(token)
+    if pending is None:
+        await query.message.edit_text(
+            "⌛ *Este enlace ya se procesó o caducó*\n\n"
+            "Envíamelo de nuevo para descargarlo",
+            parse_mode="Markdown"
+        )
+        return
+
+    url = pending["url"]
+    quality = pending["formats"][int(choice)] if choice.isdigit() else choice
+
+    cancel_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("❌ Cancelar", callback_data=f"{token}:stop")]
+    ])
     status_msg = await query.message.edit_text(
         "⏳ *Descargando video...*\n\n"
         "Por favor espera, esto puede tardar un momento",
+        reply_markup=cancel_markup,
         parse_mode="Markdown"
     )
 
+    files = []
+    stopped = False
+
     try:
-        # QUITADO el await - download() NO es async
-        files, platform = await download(url, quality)
+        # Si ya se subió antes, reenviar por file_id
+        cache_key = make_cache_key(url, quality)
+        cached = await get_cached_media(cache_key)
+        if cached:
+            items, platform = cached
+            await send_cached_media(query.message, items, platform)
+        else:
+            progress = ProgressEditor(status_msg, cancel_markup)
+            task = asyncio.create_task(scheduler.submit(
+                query.from_user.id, download, url, quality, progress.update,
+                on_position=queue_feedback(status_msg, cancel_markup)
+            ))
+            active_downloads[token] = task
+            watcher = asyncio.create_task(watch_cancel(token, task)) if WEBHOOK_URL else None
+            try:
+                files, platform = await task
+            finally:
+                del active_downloads[token]
+                stopped = token in stopped_downloads
+                stopped_downloads.discard(token)
+                progress.close()
+                if watcher is not None:
+                    watcher.cancel()
 
-        if not files:
-            await status_msg.edit_text("❌ No se pudo descargar el contenido")
-            return
+            if not files:
+                await status_msg.edit_text("❌ No se pudo descargar el contenido")
+                return
 
-        await status_msg.edit_text("📤 *Enviando archivo(s)...*", parse_mode="Markdown")
+            await status_msg.edit_text("📤 *Enviando archivo(s)...*", parse_mode="Markdown")
 
-        # Enviar archivo(s)
-        for idx, file in enumerate(files):
-            try:
-                if file.endswith((".mp4", ".webm", ".mov")):
-                    with open(file, "rb") as video:
-                        caption = f"✅ Descargado de *{platform}*" if idx == 0 else None
-                        await query.message.reply_video(
-                            video=video,
-                            caption=caption,
-                            parse_mode="Markdown",
-                            supports_streaming=True
-                        )
-                elif file.endswith((".jpg", ".jpeg", ".png", ".webp")):
-                    with open(file, "rb") as photo:
-                        await query.message.reply_photo(photo=photo)
-                
-                # Limpiar archivo
-                if os.path.exists(file):
-                    os.remove(file)
-            except Exception as e:
-                print(f"Error enviando archivo {file}: {e}")
-                continue
+            # Enviar archivo(s)
+            uploaded = []
+            upload_ok = True
+            for idx, file in enumerate(list(files)):
+                try:
+                    sent = None
+                    size = os.path.getsize(file)
+                    with timed("upload"):
+                        if file.endswith((".mp4", ".webm", ".mov")):
+                            with open_upload(file) as video:
+                                caption = f"✅ Descargado de *{platform}*" if idx == 0 else None
+                                sent = await query.message.reply_video(
+                                    video=video,
+                                    caption=caption,
+                                    parse_mode="Markdown",
+                                    supports_streaming=True
+                                )
+                        elif file.endswith((".jpg", ".jpeg", ".png", ".webp")):
+                            with open_upload(file) as photo:
+                                sent = await query.message.reply_photo(photo=photo)
+
+                    if sent:
+                        UPLOADED_BYTES.labels(platform=platform).inc(size)
+                    if sent and sent_file_id(sent):
+                        uploaded.append(sent_file_id(sent))
+                except Exception as e:
+                    upload_ok = False
+                    print(f"Error enviando archivo {file}: {e}")
+                    error("upload", platform)
+                    continue
+                finally:
+                    # Liberar archivo (se borra cuando nadie más lo está enviando)
+                    files.remove(file)
+                    release_file(file)
+
+            # Si algo no llegó, avisar en lugar de dar la descarga por buena
+            if not uploaded or not upload_ok:
+                await status_msg.edit_text(
+                    "❌ *Error al enviar el video*\n\n"
+                    + ("Algunas partes no se pudieron enviar.\n" if uploaded else "Telegram no aceptó el archivo.\n")
+                    + "Prueba con una calidad menor",
+                    parse_mode="Markdown"
+                )
+                return
+
+            save_cached_media(cache_key, platform, uploaded)
 
         # Eliminar mensaje de estado
         await status_msg.delete()
 
         # Guardar estadísticas
         user = query.from_user
-        save_download(user.id, user.username or "Sin username", url, platform, "video")
+        save_download(user.id, user.username or "Sin username", url, platform, "video", user.first_name)
         
         # Mostrar stats
-        stats = get_user_stats(user.id)
+        stats = await get_user_stats(user.id)
         await query.message.reply_text(
             f"✅ *Descarga completada*\n\n"
             f"📊 Total de descargas: *{stats}*",
             parse_mode="Markdown"
         )
 
+    except asyncio.CancelledError:
+        # Solo la descarga se canceló (botón); si es el propio handler, propagar
+        if not stopped:
+            raise
+        await status_msg.edit_text("❌ Descarga cancelada")
+
+    except QueueFullError:
+        await queue_full(status_msg)
+
+    except UpstreamUnavailable as e:
+        await upstream_unavailable(status_msg, e)
+
     except Exception as e:
         await status_msg.edit_text(
             f"❌ *Error al descargar*\n\n"
@@ -213,63 +638,143 @@ async def download_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         print(f"Error en download_video: {e}")
 
+    finally:
+        for f in files:
+            release_file(f)
 
-# ---------- DESCARGA DE ÁLBUMES ----------
 
-async def process_album(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    url = context.user_data.get("url")
-    status_msg = context.user_data.get("status_msg")
+# ---------- ENVÍO EN STREAMING ----------
 
-    try:
-        # QUITADO el await - download() NO es async
-        files, platform = await download(url, quality=None)
+VIDEO_EXTS = (".mp4", ".webm", ".mov")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
 
-        if not files:
-            await status_msg.edit_text("❌ No se encontraron imágenes en el álbum")
-            return
 
-        # Filtrar solo imágenes
-        image_files = [f for f in files if f.endswith((".jpg", ".jpeg", ".png", ".webp"))]
-        
-        if not image_files:
-            await status_msg.edit_text("❌ No se encontraron imágenes válidas")
-            return
+@contextmanager
+def open_upload(path):
+    """
+    Origen de la subida de un archivo: con servidor local de la Bot API, su ruta
+    (el servidor lo lee del disco y los bytes no pasan por Python); si no, el archivo abierto
+    """
+    if BOT_API_LOCAL_MODE:
+        yield Path(path).absolute()
+    else:
+        with open(path, "rb") as f:
+            yield f
 
-        await status_msg.edit_text(
-            f"📤 *Enviando {len(image_files)} imágenes...*",
-            parse_mode="Markdown"
-        )
 
-        # Enviar en grupos de 10 (límite de Telegram)
-        for i in range(0, len(image_files), 10):
-            batch = image_files[i:i+10]
-            media_group = []
-            
-            for img in batch:
-                with open(img, "rb") as photo:
-                    media_group.append(InputMediaPhoto(media=photo.read()))
+async def send_photo_batch(message, batch, platform):
+    """
+    Sube hasta 10 imágenes desde disco (sin leerlas antes a memoria),
+    libera cada archivo tras enviarlo y devuelve sus file_id
+    """
+    size = sum(os.path.getsize(img) for img in batch)
+    with ExitStack() as stack, timed("upload"):
+        handles = [stack.enter_context(open_upload(img)) for img in batch]
+        sent_messages = await reply_media(message, [("photo", handle) for handle in handles])
+    UPLOADED_BYTES.labels(platform=platform).inc(size)
+
+    for img in batch:
+        release_file(img)
+
+    return [sent_file_id(m) for m in sent_messages if sent_file_id(m)]
+
+
+async def stream_and_send(message, status_msg, url, quality, files):
+    """
+    Descarga y envía a la vez: cada video sale en cuanto termina y las imágenes
+    en grupos de 10 en cuanto se llena uno. Devuelve (file_ids, plataforma).
+    En files quedan los archivos recibidos que aún no se han liberado
+    """
+    uploaded = []
+    batch = []
+    platform = detect_platform(url)
+
+    async for file, platform in download_stream(url, quality):
+        files.append(file)
+
+        if file.endswith(VIDEO_EXTS):
+            size = os.path.getsize(file)
+            with timed("upload"), open_upload(file) as vid:
+                sent = await message.reply_video(
+                    video=vid,
+                    caption=f"✅ De *{platform}*",
+                    parse_mode="Markdown",
+                    supports_streaming=True
+                )
+            UPLOADED_BYTES.labels(platform=platform).inc(size)
+            files.remove(file)
+            release_file(file)
+            if sent_file_id(sent):
+                uploaded.append(sent_file_id(sent))
+
+        elif file.endswith(IMAGE_EXTS):
+            batch.append(file)
+            # Enviar en grupos de 10 (límite de Telegram)
+            if len(batch) == 10:
+                uploaded.extend(await send_photo_batch(message, batch, platform))
+                for img in batch:
+                    files.remove(img)
+                batch = []
+                await status_msg.edit_text(
+                    f"📤 *{len(uploaded)} archivos enviados*\n\n"
+                    "⏳ Descargando el resto...",
+                    parse_mode="Markdown"
+                )
+
+    if batch:
+        uploaded.extend(await send_photo_batch(message, batch, platform))
+        for img in batch:
+            files.remove(img)
+
+    return uploaded, platform
 
-            await update.message.reply_media_group(media_group)
+
+# ---------- DESCARGA DE ÁLBUMES ----------
+
+async def process_album(update: Update, context: ContextTypes.DEFAULT_TYPE, url, status_msg):
+    files = []
+
+    try:
+        # Si ya se subió antes, reenviar por file_id
+        cache_key = make_cache_key(url, "album")
+        cached = await get_cached_media(cache_key)
+        if cached:
+            uploaded, platform = cached
+            await send_cached_media(update.message, uploaded, platform)
+        else:
+            # Las imágenes se envían mientras se descarga el resto
+            uploaded, platform = await scheduler.submit(
+                update.effective_user.id, stream_and_send,
+                update.message, status_msg, url, None, files,
+                on_position=queue_feedback(status_msg)
+            )
+
+            if not uploaded:
+                await status_msg.edit_text("❌ No se encontraron imágenes en el álbum")
+                return
+
+            save_cached_media(cache_key, platform, uploaded)
         
         # Eliminar mensaje de estado
         await status_msg.delete()
         
         # Mensaje final
         user = update.message.from_user
-        save_download(user.id, user.username or "Sin username", url, platform, "album")
+        save_download(user.id, user.username or "Sin username", url, platform, "album", user.first_name)
         
-        stats = get_user_stats(user.id)
+        stats = await get_user_stats(user.id)
         await update.message.reply_text(
             f"✅ *Álbum descargado*\n\n"
-            f"📸 {len(image_files)} imágenes de *{platform}*\n"
+            f"📸 {len(uploaded)} imágenes de *{platform}*\n"
             f"📊 Total de descargas: *{stats}*",
             parse_mode="Markdown"
         )
 
-        # Limpiar archivos
-        for f in files:
-            if os.path.exists(f):
-                os.remove(f)
+    except QueueFullError:
+        await queue_full(status_msg)
+
+    except UpstreamUnavailable as e:
+        await upstream_unavailable(status_msg, e)
 
     except Exception as e:
         await status_msg.edit_text(
@@ -279,68 +784,59 @@ async def process_album(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         print(f"Error en process_album: {e}")
 
+    finally:
+        # Liberar archivos que no llegaron a enviarse
+        for f in files:
+            release_file(f)
+
 
 # ---------- DESCARGA INSTAGRAM ----------
 
-async def process_instagram(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    url = context.user_data.get("url")
-    status_msg = context.user_data.get("status_msg")
+async def process_instagram(update: Update, context: ContextTypes.DEFAULT_TYPE, url, status_msg):
+    files = []
 
     try:
-        # QUITADO el await - download() NO es async
-        files, platform = await download(url, quality="best")
-
-        if not files:
-            await status_msg.edit_text("❌ No se pudo descargar el contenido")
-            return
-
-        # Separar videos e imágenes
-        videos = [f for f in files if f.endswith((".mp4", ".webm", ".mov"))]
-        images = [f for f in files if f.endswith((".jpg", ".jpeg", ".png", ".webp"))]
+        # Si ya se subió antes, reenviar por file_id
+        cache_key = make_cache_key(url, "best")
+        cached = await get_cached_media(cache_key)
+        if cached:
+            uploaded, platform = cached
+            await send_cached_media(update.message, uploaded, platform)
+        else:
+            # Cada video/grupo de imágenes se envía en cuanto está listo
+            uploaded, platform = await scheduler.submit(
+                update.effective_user.id, stream_and_send,
+                update.message, status_msg, url, "best", files,
+                on_position=queue_feedback(status_msg)
+            )
 
-        await status_msg.edit_text("📤 *Enviando contenido...*", parse_mode="Markdown")
+            if not uploaded:
+                await status_msg.edit_text("❌ No se pudo descargar el contenido")
+                return
 
-        # Enviar videos
-        for video in videos:
-            with open(video, "rb") as vid:
-                await update.message.reply_video(
-                    video=vid,
-                    caption=f"✅ De *{platform}*",
-                    parse_mode="Markdown",
-                    supports_streaming=True
-                )
-        
-        # Enviar imágenes como media group
-        if images:
-            for i in range(0, len(images), 10):
-                batch = images[i:i+10]
-                media_group = []
-                
-                for img in batch:
-                    with open(img, "rb") as photo:
-                        media_group.append(InputMediaPhoto(media=photo.read()))
-                
-                await update.message.reply_media_group(media_group)
+            save_cached_media(cache_key, platform, uploaded)
         
         # Eliminar mensaje de estado
         await status_msg.delete()
         
         # Guardar stats
         user = update.message.from_user
-        content_type = "video" if videos else "images"
-        save_download(user.id, user.username or "Sin username", url, platform, content_type)
+        has_video = any(item["type"] == "video" for item in uploaded)
+        content_type = "video" if has_video else "images"
+        save_download(user.id, user.username or "Sin username", url, platform, content_type, user.first_name)
         
-        stats = get_user_stats(user.id)
+        stats = await get_user_stats(user.id)
         await update.message.reply_text(
             f"✅ *Descarga completada*\n\n"
             f"📊 Total de descargas: *{stats}*",
             parse_mode="Markdown"
         )
 
-        # Limpiar archivos
-        for f in files:
-            if os.path.exists(f):
-                os.remove(f)
+    except QueueFullError:
+        await queue_full(status_msg)
+
+    except UpstreamUnavailable as e:
+        await upstream_unavailable(status_msg, e)
 
     except Exception as e:
         await status_msg.edit_text(
@@ -350,22 +846,320 @@ async def process_instagram(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         print(f"Error en process_instagram: {e}")
 
+    finally:
+        # Liberar archivos que no llegaron a enviarse
+        for f in files:
+            release_file(f)
+
+
+# ---------- LOTES ----------
+
+def batch_text(state):
+    done = state["done"] + state["failed"]
+    filled = int(done / state["total"] * 10)
+    text = (
+        f"📦 *Lote de {state['total']} links*\n\n"
+        f"{'█' * filled}{'░' * (10 - filled)} {done}/{state['total']}\n"
+        f"📤 {state['sent']} archivos enviados"
+    )
+    if state["failed"]:
+        text += f"\n❌ {state['failed']} fallidos"
+    return text
+
+
+class BatchSender:
+    """
+    Junta lo que van dejando las descargas de un lote (fotos y videos
+    mezclados, de cualquier link) y lo envía en grupos de 10, que es el
+    máximo por media group. Guarda qué file_id corresponde a cada link
+    """
+
+    def __init__(self, message, on_sent=None):
+        self.message = message
+        self.on_sent = on_sent
+        self.pending = []  # (clave de caché, plataforma, tipo, ruta o file_id, es_archivo)
+        self.file_ids = {}  # clave de caché -> file_id enviados
+        self.failed = set()
+        self.sent = 0
+        self.lock = asyncio.Lock()
+
+    async def add(self, items):
+        self.pending.extend(items)
+        while len(self.pending) >= 10:
+            await self.flush(10)
+
+    async def flush(self, count=None):
+        async with self.lock:
+            # Otro envío pudo llevarse ya los elementos mientras se esperaba el lock
+            if count and len(self.pending) < count:
+                return
+            batch = self.pending[:count or len(self.pending)]
+            del self.pending[:len(batch)]
+            if batch:
+                await self._send(batch)
+
+    async def _send(self, batch):
+        files = [source for *_, source, is_file in batch if is_file]
+        sent_messages = []
+        try:
+            sizes = {}
+            for _, platform, _, source, is_file in batch:
+                if is_file:
+                    sizes[platform] = sizes.get(platform, 0) + os.path.getsize(source)
+
+            with ExitStack() as stack, timed("upload"):
+                media = [
+                    (kind, stack.enter_context(open_upload(source)) if is_file else source)
+                    for _, _, kind, source, is_file in batch
+                ]
+                sent_messages = await reply_media(self.message, media)
+
+            for platform, size in sizes.items():
+                UPLOADED_BYTES.labels(platform=platform).inc(size)
+        except Exception as e:
+            print(f"Error enviando grupo del lote: {e}")
+            for platform in {platform for _, platform, _, _, _ in batch}:
+                error("upload", platform)
+            self.failed.update(key for key, *_ in batch)
+        finally:
+            for file in files:
+                release_file(file)
+
+        for (key, *_), sent in zip(batch, sent_messages):
+            if sent_file_id(sent):
+                self.file_ids.setdefault(key, []).append(sent_file_id(sent))
+        self.sent += len(sent_messages)
+        if self.on_sent:
+            self.on_sent()
+
+
+async def batch_item(link, user_id, sender, semaphore):
+    """
+    Descarga (o toma de la caché) un link del lote y entrega sus archivos al
+    sender. Devuelve (clave de caché, plataforma, elementos, si venía de caché)
+    """
+    quality = None if link.kind == "album" else "best"
+    cache_key = make_cache_key(link.url, "album" if link.kind == "album" else "best")
+
+    cached = await get_cached_media(cache_key)
+    if cached:
+        items, platform = cached
+        await sender.add([(cache_key, platform, item["type"], item["file_id"], False) for item in items])
+        return cache_key, platform, [item["type"] for item in items], True
+
+    # Como mucho MAX_JOBS_PER_USER a la vez: el resto del lote no ocupa la cola global
+    async with semaphore:
+        files, platform = await scheduler.submit(user_id, download, link.url, quality)
+
+    items = []
+    for file in files:
+        if file.endswith(VIDEO_EXTS):
+            items.append((cache_key, platform, "video", file, True))
+        elif file.endswith(IMAGE_EXTS):
+            items.append((cache_key, platform, "photo", file, True))
+        else:
+            release_file(file)
+    if not items:
+        raise RuntimeError("No se pudo descargar el contenido")
+    await sender.add(items)
+    return cache_key, platform, [kind for _, _, kind, _, _ in items], False
+
+
+async def process_batch(update: Update, links):
+    """
+    Varios links en un mensaje: se descargan a la vez (dentro de los límites de
+    la cola), sus archivos se envían juntos en media groups y el avance se
+    muestra en un único mensaje
+    """
+    user = update.effective_user
+    state = {"total": len(links), "done": 0, "failed": 0, "sent": 0}
+    status_msg = await update.message.reply_text(batch_text(state), parse_mode="Markdown")
+    progress = ProgressEditor(status_msg, render=batch_text)
+
+    def refresh():
+        state["sent"] = sender.sent
+        progress.update(dict(state))
+
+    sender = BatchSender(update.message, on_sent=refresh)
+    semaphore = asyncio.Semaphore(scheduler.per_user)
+
+    async def run(link):
+        try:
+            result = await batch_item(link, user.id, sender, semaphore)
+            state["done"] += 1
+            return link, result
+        except Exception as e:
+            print(f"Error en lote con {link.url}: {e}")
+            state["failed"] += 1
+            return link, None
+        finally:
+            refresh()
+
+    try:
+        results = await asyncio.gather(*(run(link) for link in links))
+        await sender.flush()
+    finally:
+        progress.close()
+        # Archivos que no llegaron a enviarse
+        for *_, source, is_file in sender.pending:
+            if is_file:
+                release_file(source)
+
+    ok = 0
+    for link, result in results:
+        if result is None:
+            continue
+        cache_key, platform, kinds, from_cache = result
+        if cache_key in sender.failed:
+            continue
+        ok += 1
+        uploaded = sender.file_ids.get(cache_key, [])
+        if not from_cache and len(uploaded) == len(kinds):
+            save_cached_media(cache_key, platform, uploaded)
+        if link.kind == "album":
+            content_type = "album"
+        else:
+            content_type = "video" if "video" in kinds else "images"
+        save_download(user.id, user.username or "Sin username", link.url, platform, content_type, user.first_name)
+
+    await status_msg.delete()
+    stats = await get_user_stats(user.id)
+    text = (
+        f"✅ *Lote completado*\n\n"
+        f"📦 {ok}/{len(links)} links · {sender.sent} archivos\n"
+    )
+    if ok < len(links):
+        text += f"❌ {len(links) - ok} no se pudieron descargar\n"
+    text += f"📊 Total de descargas: *{stats}*"
+    await update.message.reply_text(text, parse_mode="Markdown")
+
 
 # ---------- APP ----------
 
-def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+# Cuándo terminó de cargarse el bot (para medir lo que tarda en estar listo)
+loaded_at = time.monotonic()
+
+# Tareas de arranque en segundo plano (se cancelan al parar)
+background_tasks = set()
+
+
+async def start_browser_pool():
+    # Navegador caliente para el scraper de respaldo (si falla, se arranca al primer uso)
+    try:
+        await browser_pool.start()
+    except Exception as e:
+        print(f"No se pudo arrancar el navegador: {e}")
+
+
+async def warm_up():
+    """
+    Precalienta lo que solo necesitan algunas descargas, sin retrasar el
+    arranque: si llega una petición antes, cada pieza se carga al usarse
+    """
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(
+        loop.run_in_executor(None, importlib.import_module, "yt_dlp"),
+        start_browser_pool(),
+        tiktok_pool.start(),
+        return_exceptions=True
+    )
+
+
+async def signal_ready(app):
+    """Marca el bot como listo en cuanto el polling o el webhook aceptan actualizaciones"""
+    while not (app.running and (app.updater is None or app.updater.running)):
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - loaded_at
+    READY.set(1)
+    STARTUP_SECONDS.set(elapsed)
+    if READY_FILE:
+        Path(READY_FILE).touch()
+    print(f"✅ Listo para recibir mensajes ({elapsed:.2f} s)")
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def on_startup(app):
+    # Lo imprescindible para atender mensajes, en paralelo
+    await asyncio.gather(init_db(), workspace.start())
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_PORT, METRICS_ADDR)
+        except OSError as e:
+            # Otro proceso del mismo equipo ya tiene el puerto: seguir sin métricas
+            print(f"⚠️ No se pudo abrir /metrics en {METRICS_ADDR}:{METRICS_PORT}: {e}")
+    if WARMUP_BACKENDS:
+        run_in_background(warm_up())
+    run_in_background(signal_ready(app))
+
+
+async def on_shutdown(app):
+    READY.set(0)
+    if READY_FILE and os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+    for task in list(background_tasks):
+        task.cancel()
+    await close_db()
+    await workspace.stop()
+    await tiktok_pool.stop()
+    await browser_pool.stop()
+    await close_client()
+
+
+def build_app():
+    # Actualizaciones concurrentes: la cola de descargas pone los límites
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+
+    # Servidor propio de la Bot API (archivos de hasta 2000 MB, subidas por ruta)
+    if BOT_API_SERVER:
+        builder = (
+            builder
+            .base_url(f"{BOT_API_SERVER}/bot")
+            .base_file_url(f"{BOT_API_SERVER}/file/bot")
+            .local_mode(BOT_API_LOCAL_MODE)
+        )
+
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("stats", stats))
     app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("top", top_command))
+    app.add_handler(CommandHandler("platforms", platforms_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link))
+    app.add_handler(MessageHandler(filters.Document.FileExtension("txt"), handle_document))
     app.add_handler(CallbackQueryHandler(download_video))
+    return app
+
+
+def main():
+    app = build_app()
 
     print("🤖 Bot iniciado correctamente")
     print("📥 Esperando mensajes...")
     
-    app.run_polling()
+    if WEBHOOK_URL:
+        # Varias instancias pueden servir el mismo token detrás de un balanceador:
+        # el estado de cada petición vive en el almacén compartido, no en memoria
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
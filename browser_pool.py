@@ -0,0 +1,123 @@
+import asyncio
+from contextlib import asynccontextmanager
+from config import BROWSER_POOL_SIZE, BROWSER_MAX_PAGES
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
+# Recursos que no hacen falta para descubrir las URLs de las imágenes
+BLOCKED_RESOURCES = {"image", "font", "media"}
+
+
+async def block_heavy_resources(route):
+    if route.request.resource_type in BLOCKED_RESOURCES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+class PooledContext:
+    def __init__(self, browser, context):
+        self.browser = browser
+        self.context = context
+        self.pages = 0
+
+
+class BrowserPool:
+    """
+    Chromium persistente con un conjunto de contextos reutilizables.
+    Cada contexto se recicla tras max_pages páginas o si falla
+    """
+
+    def __init__(self, size=2, max_pages=50):
+        self.size = size
+        self.max_pages = max_pages
+        self._playwright = None
+        self._browser = None
+        self._contexts = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """Arranca el navegador y precalienta los contextos"""
+        async with self._lock:
+            if self._contexts is not None:
+                return
+            # Importado al primer uso para no alargar el arranque del bot
+            from playwright.async_api import async_playwright
+            self._playwright = await async_playwright().start()
+            try:
+                await self._launch()
+                contexts = asyncio.Queue()
+                for _ in range(self.size):
+                    await contexts.put(await self._new_context())
+            except Exception:
+                await self._playwright.stop()
+                self._playwright = None
+                raise
+            self._contexts = contexts
+
+    async def stop(self):
+        async with self._lock:
+            if self._contexts is None:
+                return
+            while not self._contexts.empty():
+                pooled = self._contexts.get_nowait()
+                await self._close_context(pooled)
+            self._contexts = None
+            if self._browser is not None:
+                try:
+                    await self._browser.close()
+                except Exception:
+                    pass
+                self._browser = None
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def _launch(self):
+        self._browser = await self._playwright.chromium.launch(headless=True)
+
+    async def _new_context(self):
+        # Relanzar el navegador si se cayó
+        if self._browser is None or not self._browser.is_connected():
+            print("Navegador caído, relanzando Chromium...")
+            await self._launch()
+        context = await self._browser.new_context(user_agent=USER_AGENT)
+        await context.route("**/*", block_heavy_resources)
+        return PooledContext(self._browser, context)
+
+    async def _close_context(self, pooled):
+        try:
+            await pooled.context.close()
+        except Exception:
+            pass
+
+    async def _recycle(self, pooled):
+        await self._close_context(pooled)
+        async with self._lock:
+            return await self._new_context()
+
+    @asynccontextmanager
+    async def lease(self):
+        """Presta un contexto del pool (espera si están todos ocupados)"""
+        if self._contexts is None:
+            await self.start()
+
+        pooled = await self._contexts.get()
+        failed = False
+        try:
+            if not pooled.browser.is_connected():
+                pooled = await self._recycle(pooled)
+            yield pooled.context
+        except Exception:
+            failed = True
+            raise
+        finally:
+            pooled.pages += 1
+            if failed or pooled.pages >= self.max_pages or not pooled.browser.is_connected():
+                try:
+                    pooled = await self._recycle(pooled)
+                except Exception as e:
+                    print(f"Error reciclando contexto del navegador: {e}")
+            await self._contexts.put(pooled)
+
+
+browser_pool = BrowserPool(BROWSER_POOL_SIZE, BROWSER_MAX_PAGES)
\ No newline at end of file
@@ -3,4 +3,172 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-TOKEN = os.getenv("BOT_TOKEN")
\ No newline at end of file
+TOKEN = os.getenv("BOT_TOKEN")
+
+# Servidor propio de la Bot API (p. ej. http://localhost:8081). En modo local las
+# subidas se hacen por ruta de archivo, así que el servidor debe ver la carpeta de trabajo (WORKSPACE_DIR)
+BOT_API_SERVER = os.getenv("BOT_API_SERVER", "").rstrip("/")
+BOT_API_LOCAL_MODE = os.getenv("BOT_API_LOCAL_MODE", "true" if BOT_API_SERVER else "false").lower() == "true"
+
+# Base de datos (escrituras agrupadas cada N ms o M filas)
+DB_PATH = os.getenv("DB_PATH", "history.db")
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "100"))
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", "200"))
+
+# Usuarios cuyo total de descargas se mantiene en memoria
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "10000"))
+# Segundos que vale cada total en memoria (0 = siempre). Con webhook puede haber varias
+# instancias escribiendo, así que por defecto se vuelve a leer de la base de datos enseguida
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "10" if os.getenv("WEBHOOK_URL") else "0"))
+
+# Historial: días que se guarda cada descarga (0 = siempre) y días que cuentan para el
+# ranking de links; los totales por día, plataforma y tipo se conservan siempre
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "90"))
+TOP_URLS_RETENTION_DAYS = int(os.getenv("TOP_URLS_RETENTION_DAYS", "30"))
+# Ventanas del ranking (días) que se mantienen al día con cada lote; /top usa la menor
+# que cubra los días pedidos. La de TOP_URLS_RETENTION_DAYS siempre está
+TOP_URLS_WINDOWS = sorted(
+    {int(days) for days in os.getenv("TOP_URLS_WINDOWS", "1,7").replace(",", " ").split()
+     if 0 < int(days) < TOP_URLS_RETENTION_DAYS} | {TOP_URLS_RETENTION_DAYS}
+)
+
+# IDs de Telegram (separados por comas) que pueden usar /top y /platforms
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(",", " ").split()}
+
+# Caché de file_id de Telegram (segundos de vida y máximo de entradas)
+CACHE_TTL = int(os.getenv("CACHE_TTL", "604800"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+
+# Cola de descargas
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "2"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "50"))
+
+# Velocidad de yt-dlp: fragmentos DASH/HLS en paralelo, video y audio a la vez
+# antes de unirlos, y descargador externo opcional (p. ej. "aria2c", si está instalado)
+CONCURRENT_FRAGMENTS = int(os.getenv("CONCURRENT_FRAGMENTS", "4"))
+PARALLEL_AV_STREAMS = os.getenv("PARALLEL_AV_STREAMS", "true").lower() == "true"
+EXTERNAL_DOWNLOADER = os.getenv("EXTERNAL_DOWNLOADER", "")
+EXTERNAL_DOWNLOADER_ARGS = os.getenv("EXTERNAL_DOWNLOADER_ARGS", "-x 8 -s 8 -k 1M")
+
+# Ajustes por plataforma (YOUTUBE_CONCURRENT_FRAGMENTS, TIKTOK_EXTERNAL_DOWNLOADER...);
+# chunk_size parte las descargas HTTP en trozos (YouTube limita las conexiones largas)
+DOWNLOAD_TUNING = {
+    "YouTube": {
+        "fragments": int(os.getenv("YOUTUBE_CONCURRENT_FRAGMENTS", "8")),
+        "chunk_size": int(os.getenv("YOUTUBE_HTTP_CHUNK_SIZE", str(10 * 1024 * 1024))),
+        "external_downloader": os.getenv("YOUTUBE_EXTERNAL_DOWNLOADER", EXTERNAL_DOWNLOADER),
+    },
+    "TikTok": {
+        "fragments": int(os.getenv("TIKTOK_CONCURRENT_FRAGMENTS", str(CONCURRENT_FRAGMENTS))),
+        "chunk_size": int(os.getenv("TIKTOK_HTTP_CHUNK_SIZE", "0")),
+        "external_downloader": os.getenv("TIKTOK_EXTERNAL_DOWNLOADER", EXTERNAL_DOWNLOADER),
+    },
+    "Instagram": {
+        "fragments": int(os.getenv("INSTAGRAM_CONCURRENT_FRAGMENTS", str(CONCURRENT_FRAGMENTS))),
+        "chunk_size": int(os.getenv("INSTAGRAM_HTTP_CHUNK_SIZE", "0")),
+        "external_downloader": os.getenv("INSTAGRAM_EXTERNAL_DOWNLOADER", EXTERNAL_DOWNLOADER),
+    },
+}
+
+# Peticiones a cada plataforma (extracciones por segundo y ráfaga máxima): el ritmo se
+# reduce a la mitad con cada 429/403 y se recupera poco a poco con las que salen bien.
+# Si hubiera que esperar más de UPSTREAM_MAX_WAIT segundos, la petición falla en el acto
+UPSTREAM_RATE = {
+    "YouTube": float(os.getenv("YOUTUBE_RATE", "2")),
+    "TikTok": float(os.getenv("TIKTOK_RATE", "1")),
+    "Instagram": float(os.getenv("INSTAGRAM_RATE", "0.5")),
+}
+UPSTREAM_MIN_RATE = float(os.getenv("UPSTREAM_MIN_RATE", "0.05"))
+UPSTREAM_BURST = int(os.getenv("UPSTREAM_BURST", "5"))
+UPSTREAM_MAX_WAIT = float(os.getenv("UPSTREAM_MAX_WAIT", "20"))
+
+# Cortacircuitos: fallos seguidos que lo abren, segundos abierto (se duplica cada vez
+# que vuelve a abrirse, hasta el máximo) y cada cuánto se lee el estado de otras instancias
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", "60"))
+BREAKER_MAX_COOLDOWN = int(os.getenv("BREAKER_MAX_COOLDOWN", "900"))
+UPSTREAM_SYNC_INTERVAL = int(os.getenv("UPSTREAM_SYNC_INTERVAL", "5"))
+
+# Carpeta de trabajo: una subcarpeta por descarga, cuota total y espacio libre mínimo
+# en disco (MB), y segundos sin cambios tras los que el limpiador borra lo abandonado.
+# WORKSPACE_TMPFS (p. ej. /dev/shm) guarda ahí las descargas pequeñas; no usarlo si el
+# servidor local de la Bot API no puede leer esa carpeta
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "media")
+WORKSPACE_TMPFS = os.getenv("WORKSPACE_TMPFS", "")
+WORKSPACE_TMPFS_MAX = int(os.getenv("WORKSPACE_TMPFS_MAX_MB", "20")) * 1024 * 1024
+WORKSPACE_QUOTA = int(os.getenv("WORKSPACE_QUOTA_MB", "10240")) * 1024 * 1024
+WORKSPACE_MIN_FREE = int(os.getenv("WORKSPACE_MIN_FREE_MB", "1024")) * 1024 * 1024
+WORKSPACE_MAX_AGE = int(os.getenv("WORKSPACE_MAX_AGE", "3600"))
+# Tope por imagen (KB) con el que se estima lo que ocupa un álbum antes de bajarlo
+ALBUM_IMAGE_MAX_SIZE = int(os.getenv("ALBUM_IMAGE_MAX_KB", "1536")) * 1024
+JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "300"))
+
+# Métricas para Prometheus en http://METRICS_ADDR:METRICS_PORT/metrics (0 = desactivadas)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+
+# Enlaces cortos (vm.tiktok.com...) ya resueltos: segundos de vida y máximo de entradas
+SHORT_LINK_CACHE_TTL = int(os.getenv("SHORT_LINK_CACHE_TTL", "86400"))
+SHORT_LINK_CACHE_SIZE = int(os.getenv("SHORT_LINK_CACHE_SIZE", "1000"))
+
+# Lotes: máximo de links por mensaje o archivo .txt, y tamaño máximo del .txt (bytes)
+MAX_BATCH_LINKS = int(os.getenv("MAX_BATCH_LINKS", "30"))
+MAX_BATCH_FILE_SIZE = int(os.getenv("MAX_BATCH_FILE_SIZE", str(256 * 1024)))
+
+# Segundos mínimos entre ediciones del mensaje de progreso (límite de Telegram)
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))
+
+# Cliente HTTP compartido (imágenes de álbumes)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+IMAGE_FETCH_CONCURRENCY = int(os.getenv("IMAGE_FETCH_CONCURRENCY", "8"))
+
+# Navegador persistente para el scraper de respaldo de TikTok
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "2"))
+BROWSER_MAX_PAGES = int(os.getenv("BROWSER_MAX_PAGES", "50"))
+
+# Sesiones de TikTokApi (segundos sin uso antes de renovar, fallos antes de rotar)
+TIKTOK_SESSIONS = int(os.getenv("TIKTOK_SESSIONS", "2"))
+TIKTOK_SESSION_MAX_IDLE = int(os.getenv("TIKTOK_SESSION_MAX_IDLE", "600"))
+TIKTOK_SESSION_MAX_FAILURES = int(os.getenv("TIKTOK_SESSION_MAX_FAILURES", "3"))
+
+# Límite de subida de la Bot API (bytes; 2000 MB con servidor local) y sondeo de formatos
+# (segundos de vida, entradas e hilos propios, aparte de los de descarga)
+DEFAULT_UPLOAD_SIZE = (2000 if BOT_API_LOCAL_MODE else 50) * 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(DEFAULT_UPLOAD_SIZE)))
+PROBE_CACHE_TTL = int(os.getenv("PROBE_CACHE_TTL", "600"))
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE", "500"))
+PROBE_WORKERS = int(os.getenv("PROBE_WORKERS", "2"))
+
+# Postprocesado con ffmpeg para videos que superan el límite (bitrates en kbps)
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", "2"))
+MIN_VIDEO_BITRATE = int(os.getenv("MIN_VIDEO_BITRATE", "300"))
+AUDIO_BITRATE = int(os.getenv("AUDIO_BITRATE", "96"))
+
+# Fotos de álbumes: lado máximo (px) y tamaño máximo (bytes) que se envían como foto,
+# lado mínimo para no tomarlas por iconos, calidad JPEG al recomprimir, distancia máxima
+# entre hashes perceptuales para considerarlas repetidas y procesos para Pillow
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "2560"))
+PHOTO_MAX_BYTES = int(os.getenv("PHOTO_MAX_BYTES", str(10 * 1024 * 1024)))
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", "320"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "87"))
+PHOTO_DUPLICATE_DISTANCE = int(os.getenv("PHOTO_DUPLICATE_DISTANCE", "4"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 2)))
+
+# Peticiones pendientes de elegir calidad: "sqlite" (compartido entre procesos) o "memory"
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+PENDING_REQUEST_TTL = int(os.getenv("PENDING_REQUEST_TTL", "3600"))
+
+# Arranque: precalentar en segundo plano yt-dlp, el navegador y las sesiones de TikTok
+# (si no, se cargan al primer uso), y archivo que se crea cuando el bot ya recibe
+# mensajes y se borra al pararse (p. ej. para la readinessProbe de Kubernetes)
+WARMUP_BACKENDS = os.getenv("WARMUP_BACKENDS", "true").lower() == "true"
+READY_FILE = os.getenv("READY_FILE", "")
+
+# Modo webhook (si WEBHOOK_URL está vacío se usa polling)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
\ No newline at end of file
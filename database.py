@@ -1,9 +1,62 @@
 import sqlite3
-from datetime import datetime
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    DB_PATH, DB_BATCH_SIZE, DB_FLUSH_INTERVAL_MS, CACHE_TTL, CACHE_MAX_ENTRIES, STATS_CACHE_SIZE, STATS_CACHE_TTL,
+    PENDING_REQUEST_TTL, HISTORY_RETENTION_DAYS, TOP_URLS_RETENTION_DAYS, TOP_URLS_WINDOWS
+)
+from metrics import timed, cache_result, error
 
-def init_db():
-    conn = sqlite3.connect("history.db")
-    c = conn.cursor()
+# Una única conexión persistente, usada solo desde su propio hilo
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+conn = None
+
+# Escrituras en espera (write-behind)
+pending = []
+writer_task = None
+batch_ready = None
+flush_lock = None
+
+# Total de descargas por usuario en memoria (LRU): user_id -> (cargado en, total);
+# la base de datos sigue siendo la referencia
+stats_cache = OrderedDict()
+
+# Limpieza del historial antiguo: como mucho una vez por hora, en tramos de filas
+PRUNE_INTERVAL = 3600
+PRUNE_CHUNK = 5000
+last_prune = 0
+
+
+async def run_db(func, *args):
+    """Ejecuta func(*args) en el hilo de la base de datos"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, func, *args)
+
+
+def connect():
+    global conn
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def add_missing_columns(c, table, columns):
+    """Migra bases antiguas añadiendo las columnas que falten"""
+    existing = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    for name, definition in columns:
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def init_db_sync():
+    c = connect().cursor()
     c.execute("""
         CREATE TABLE IF NOT EXISTS downloads (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -15,7 +68,67 @@ def init_db():
             date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
-    
+    add_missing_columns(c, "downloads", [("username", "TEXT"), ("content_type", "TEXT")])
+    c.execute("CREATE INDEX IF NOT EXISTS idx_downloads_user_date ON downloads(user_id, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_downloads_url ON downloads(url)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_downloads_date ON downloads(date)")
+
+    # Totales que se mantienen con cada lote, para no recorrer el historial
+    new_rollups = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_stats'"
+    ).fetchone() is None
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT,
+            platform TEXT,
+            content_type TEXT,
+            downloads INTEGER DEFAULT 0,
+            PRIMARY KEY (day, platform, content_type)
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS url_stats (
+            day TEXT,
+            url TEXT,
+            platform TEXT,
+            downloads INTEGER DEFAULT 0,
+            PRIMARY KEY (day, url)
+        )
+    """)
+    if new_rollups:
+        # Primera vez: construirlos a partir del historial que ya exista
+        c.execute(
+            "INSERT INTO daily_stats (day, platform, content_type, downloads) "
+            "SELECT date(date), COALESCE(platform, ''), COALESCE(content_type, ''), COUNT(*) "
+            "FROM downloads GROUP BY 1, 2, 3"
+        )
+        c.execute(
+            "INSERT INTO url_stats (day, url, platform, downloads) "
+            "SELECT date(date), url, MAX(platform), COUNT(*) FROM downloads "
+            "WHERE date >= ? GROUP BY 1, 2",
+            (days_ago(TOP_URLS_RETENTION_DAYS),)
+        )
+
+    # Ranking por ventana de días, sumado con cada lote: /top lee los primeros por
+    # índice en lugar de agrupar url_stats
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS top_urls (
+            days INTEGER,
+            url TEXT,
+            platform TEXT,
+            downloads INTEGER DEFAULT 0,
+            PRIMARY KEY (days, url)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_top_urls_rank ON top_urls(days, downloads)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS top_windows (
+            days INTEGER PRIMARY KEY,
+            since TEXT
+        )
+    """)
+    sync_top_windows(c)
+
     c.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -25,37 +138,467 @@ def init_db():
             total_downloads INTEGER DEFAULT 0
         )
     """)
-    
+
+    # Caché de file_id ya subidos a Telegram
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            cache_key TEXT PRIMARY KEY,
+            platform TEXT,
+            items TEXT,
+            created_at REAL,
+            last_used REAL,
+            hits INTEGER DEFAULT 0
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_media_cache_last_used ON media_cache(last_used)")
+
+    # Peticiones esperando que el usuario elija calidad (compartidas entre procesos)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS pending_requests (
+            token TEXT PRIMARY KEY,
+            data TEXT,
+            created_at REAL
+        )
+    """)
+
+    # Ritmo y cortacircuitos de cada plataforma (compartidos entre procesos)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS upstream_state (
+            platform TEXT PRIMARY KEY,
+            data TEXT,
+            updated_at REAL
+        )
+    """)
+
     conn.commit()
-    conn.close()
 
-def save_download(user_id, username, url, platform, content_type="video"):
-    conn = sqlite3.connect("history.db")
-    c = conn.cursor()
-    
-    # Guardar descarga
+
+def days_ago(days):
+    """Fecha UTC (YYYY-MM-DD) de hace N días, comparable con day y con date"""
+    return (datetime.now(timezone.utc).date() - timedelta(days=days)).isoformat()
+
+
+def sync_top_windows(c):
+    """Construye desde url_stats las ventanas configuradas que falten y quita las sobrantes"""
+    existing = {days for days, in c.execute("SELECT days FROM top_windows")}
+    for days in existing - set(TOP_URLS_WINDOWS):
+        c.execute("DELETE FROM top_urls WHERE days = ?", (days,))
+        c.execute("DELETE FROM top_windows WHERE days = ?", (days,))
+    for days in set(TOP_URLS_WINDOWS) - existing:
+        since = days_ago(days - 1)
+        c.execute(
+            "INSERT INTO top_urls (days, url, platform, downloads) "
+            "SELECT ?, url, MAX(platform), SUM(downloads) FROM url_stats WHERE day >= ? GROUP BY url",
+            (days, since)
+        )
+        c.execute("INSERT INTO top_windows (days, since) VALUES (?, ?)", (days, since))
+
+
+def expire_top_windows(c):
+    """
+    Resta de cada ventana los días que han salido de ella (solo al cambiar de
+    día, y solo las filas de esos días). Devuelve [(días, desde)] vigentes
+    """
+    windows = []
+    for days, since in c.execute("SELECT days, since FROM top_windows").fetchall():
+        cut = days_ago(days - 1)
+        if cut > since:
+            c.execute(
+                "UPDATE top_urls SET downloads = downloads - ("
+                "SELECT SUM(s.downloads) FROM url_stats s WHERE s.url = top_urls.url AND s.day >= ? AND s.day < ?"
+                ") WHERE days = ? AND url IN (SELECT url FROM url_stats WHERE day >= ? AND day < ?)",
+                (since, cut, days, since, cut)
+            )
+            c.execute("DELETE FROM top_urls WHERE days = ? AND downloads <= 0", (days,))
+            c.execute("UPDATE top_windows SET since = ? WHERE days = ?", (cut, days))
+            since = cut
+        windows.append((days, since))
+    return windows
+
+
+async def init_db():
+    await run_db(init_db_sync)
+
+
+# ---------- ESCRITURA POR LOTES ----------
+
+def update_rollups(c, downloads):
+    """Suma las descargas del lote a los totales por día y al ranking (mismo commit que las filas)"""
+    daily, urls = {}, {}
+    for d in downloads:
+        day = d["date"][:10]
+        key = (day, d["platform"] or "", d["content_type"] or "")
+        daily[key] = daily.get(key, 0) + 1
+        key = (day, d["url"])
+        urls[key] = (d["platform"], urls.get(key, (None, 0))[1] + 1)
+
+    c.executemany(
+        "INSERT INTO daily_stats (day, platform, content_type, downloads) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(day, platform, content_type) DO UPDATE SET downloads = downloads + excluded.downloads",
+        [(*key, count) for key, count in daily.items()]
+    )
+    c.executemany(
+        "INSERT INTO url_stats (day, url, platform, downloads) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(day, url) DO UPDATE SET downloads = downloads + excluded.downloads",
+        [(day, url, platform, count) for (day, url), (platform, count) in urls.items()]
+    )
+    # Las ventanas avanzan antes de sumar: una descarga de un día ya caducado no cuenta
+    c.executemany(
+        "INSERT INTO top_urls (days, url, platform, downloads) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(days, url) DO UPDATE SET downloads = downloads + excluded.downloads",
+        [
+            (days, url, platform, count)
+            for days, since in expire_top_windows(c)
+            for (day, url), (platform, count) in urls.items() if day >= since
+        ]
+    )
+
+
+def prune_history(c, now):
+    """
+    Borra las descargas más antiguas que HISTORY_RETENTION_DAYS, un tramo
+    por lote para no bloquear la base de datos, y el ranking caducado.
+    Los totales de users y daily_stats no se tocan
+    """
+    global last_prune
+    if now - last_prune < PRUNE_INTERVAL:
+        return
+    finished = True
+    if HISTORY_RETENTION_DAYS:
+        deleted = c.execute(
+            "DELETE FROM downloads WHERE id IN (SELECT id FROM downloads WHERE date < ? LIMIT ?)",
+            (days_ago(HISTORY_RETENTION_DAYS), PRUNE_CHUNK)
+        ).rowcount
+        # Si quedan más, el siguiente lote sigue borrando
+        finished = deleted < PRUNE_CHUNK
+    c.execute("DELETE FROM url_stats WHERE day < ?", (days_ago(TOP_URLS_RETENTION_DAYS),))
+    if finished:
+        last_prune = now
+
+
+def write_batch_sync(batch):
+    """Escribe un lote de operaciones en una sola transacción"""
+    downloads = [params for kind, params in batch if kind == "download"]
+    cache_entries = [params for kind, params in batch if kind == "cache"]
+    cache_hits = [params for kind, params in batch if kind == "cache_hit"]
+    upstream = [params for kind, params in batch if kind == "upstream"]
+    now = time.time()
+
+    with connect() as c:
+        if downloads:
+            c.executemany(
+                "INSERT INTO downloads (user_id, username, url, platform, content_type, date) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(d["user_id"], d["username"], d["url"], d["platform"], d["content_type"], d["date"])
+                 for d in downloads]
+            )
+            # Actualizar estadísticas del usuario sin reescribir la fila
+            c.executemany(
+                "INSERT INTO users (user_id, username, first_name, last_seen, total_downloads) "
+                "VALUES (?, ?, ?, ?, 1) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "username = excluded.username, "
+                "first_name = COALESCE(excluded.first_name, users.first_name), "
+                "last_seen = excluded.last_seen, "
+                "total_downloads = total_downloads + 1",
+                [(d["user_id"], d["username"], d["first_name"], d["date"]) for d in downloads]
+            )
+            update_rollups(c, downloads)
+            prune_history(c, now)
+
+        if cache_entries:
+            c.executemany(
+                "INSERT OR REPLACE INTO media_cache (cache_key, platform, items, created_at, last_used, hits) "
+                "VALUES (?, ?, ?, ?, ?, 0)",
+                cache_entries
+            )
+            # Expulsar caducadas y las menos usadas recientemente
+            c.execute("DELETE FROM media_cache WHERE created_at < ?", (now - CACHE_TTL,))
+            c.execute(
+                "DELETE FROM media_cache WHERE cache_key NOT IN "
+                "(SELECT cache_key FROM media_cache ORDER BY last_used DESC LIMIT ?)",
+                (CACHE_MAX_ENTRIES,)
+            )
+
+        if cache_hits:
+            # Uso para el LRU, anotado fuera del camino de lectura
+            c.executemany(
+                "UPDATE media_cache SET last_used = MAX(last_used, ?), hits = hits + 1 WHERE cache_key = ?",
+                cache_hits
+            )
+
+        if upstream:
+            # Solo el estado más reciente de cada plataforma
+            c.executemany(
+                "INSERT INTO upstream_state (platform, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(platform) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at "
+                "WHERE excluded.updated_at > upstream_state.updated_at",
+                upstream
+            )
+
+
+async def flush():
+    """
+    Escribe ya todo lo pendiente. Si falla (p. ej. "database is locked"), el
+    lote vuelve al principio de la cola para reintentarlo y se lanza el error
+    """
+    global pending
+    async with flush_lock:
+        if not pending:
+            return
+        batch, pending = pending, []
+        batch_ready.clear()
+        try:
+            with timed("db_write"):
+                await run_db(write_batch_sync, batch)
+        except Exception:
+            # El lote es una sola transacción: no se escribió nada, se repite entero
+            pending = batch + pending
+            batch_ready.set()
+            error("db_write", "sqlite")
+            raise
+
+
+async def flush_with_retry(attempts=5):
+    """flush() reintentando con espera exponencial; False si no se pudo escribir"""
+    for attempt in range(attempts):
+        try:
+            await flush()
+            return True
+        except Exception as e:
+            print(f"Error escribiendo en la base de datos: {e}")
+            if attempt + 1 < attempts:
+                await asyncio.sleep(min(DB_FLUSH_INTERVAL_MS / 1000 * 2 ** attempt, 30))
+    return False
+
+
+async def writer():
+    """Vacía la cola cada DB_FLUSH_INTERVAL_MS o en cuanto hay DB_BATCH_SIZE filas"""
+    while True:
+        await batch_ready.wait()
+        if len(pending) < DB_BATCH_SIZE:
+            await asyncio.sleep(DB_FLUSH_INTERVAL_MS / 1000)
+        await flush_with_retry()
+
+
+def enqueue_write(kind, params):
+    global writer_task, batch_ready, flush_lock
+    if writer_task is None:
+        batch_ready = asyncio.Event()
+        flush_lock = asyncio.Lock()
+        writer_task = asyncio.get_running_loop().create_task(writer())
+    pending.append((kind, params))
+    batch_ready.set()
+
+
+async def close_db():
+    """Escribe lo pendiente y cierra la conexión"""
+    global writer_task, conn
+    if writer_task is not None:
+        writer_task.cancel()
+        writer_task = None
+        if not await flush_with_retry():
+            print(f"⚠️ {len(pending)} escrituras pendientes no se pudieron guardar al cerrar")
+    if conn is not None:
+        await run_db(conn.close)
+        conn = None
+
+
+# ---------- HISTORIAL Y ESTADÍSTICAS ----------
+
+def save_download(user_id, username, url, platform, content_type="video", first_name=None):
+    """Registra una descarga (se escribe en segundo plano con el siguiente lote)"""
+    if user_id in stats_cache:
+        loaded_at, total = stats_cache[user_id]
+        stats_cache[user_id] = (loaded_at, total + 1)
+        stats_cache.move_to_end(user_id)
+    enqueue_write("download", {
+        "user_id": user_id,
+        "username": username,
+        "first_name": first_name,
+        "url": url,
+        "platform": platform,
+        "content_type": content_type,
+        # UTC y en el formato de CURRENT_TIMESTAMP, como el resto de filas
+        "date": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+    })
+
+
+def get_user_stats_sync(user_id):
+    c = connect().cursor()
+    c.execute("SELECT total_downloads FROM users WHERE user_id = ?", (user_id,))
+    result = c.fetchone()
+    return result[0] if result else 0
+
+
+async def load_user_stats(user_id):
+    """Total real: lo escrito en la base de datos más lo que aún está en cola"""
+    if flush_lock is None:
+        return await run_db(get_user_stats_sync, user_id)
+
+    # Con el lock tomado no hay ningún lote a medio escribir
+    async with flush_lock:
+        total = await run_db(get_user_stats_sync, user_id)
+        # Sumar las descargas que aún no se han escrito
+        unsaved = sum(
+            1 for kind, params in pending
+            if kind == "download" and params["user_id"] == user_id
+        )
+    return total + unsaved
+
+
+async def get_user_stats(user_id):
+    """Total de descargas del usuario (desde memoria si se consultó hace poco)"""
+    cached = stats_cache.get(user_id)
+    # Con varias instancias, otra pudo sumar descargas: los totales caducan
+    if cached and STATS_CACHE_TTL and time.monotonic() - cached[0] > STATS_CACHE_TTL:
+        cached = None
+    cache_result("stats", cached is not None)
+    if cached:
+        stats_cache.move_to_end(user_id)
+        return cached[1]
+
+    loaded_at = time.monotonic()
+    total = await load_user_stats(user_id)
+    # Otra petición pudo cargarlo mientras tanto
+    if user_id not in stats_cache or stats_cache[user_id][0] < loaded_at:
+        stats_cache[user_id] = (loaded_at, total)
+        stats_cache.move_to_end(user_id)
+        if len(stats_cache) > STATS_CACHE_SIZE:
+            stats_cache.popitem(last=False)
+    return stats_cache[user_id][1]
+
+
+# ---------- CACHÉ DE ARCHIVOS ----------
+
+def get_cached_media_sync(cache_key):
+    """Solo lectura: las caducadas se borran al escribir el siguiente lote de caché"""
+    c = connect().cursor()
     c.execute(
-        "INSERT INTO downloads (user_id, username, url, platform, content_type) VALUES (?, ?, ?, ?, ?)",
-        (user_id, username, url, platform, content_type)
+        "SELECT platform, items FROM media_cache WHERE cache_key = ? AND created_at >= ?",
+        (cache_key, time.time() - CACHE_TTL)
     )
-    
-    # Actualizar estadísticas del usuario
+    result = c.fetchone()
+    if not result:
+        return None
+    return json.loads(result[1]), result[0]
+
+
+async def get_cached_media(cache_key):
+    """Devuelve (items, platform) si hay file_id vigentes para la clave, o None"""
+    cached = await run_db(get_cached_media_sync, cache_key)
+    cache_result("media", cached is not None)
+    if cached:
+        # Marcar uso para el LRU (con el siguiente lote)
+        enqueue_write("cache_hit", (time.time(), cache_key))
+    return cached
+
+
+def save_cached_media(cache_key, platform, items):
+    """Guarda los file_id de una subida (con el siguiente lote) y aplica TTL + LRU"""
+    now = time.time()
+    enqueue_write("cache", (cache_key, platform, json.dumps(items), now, now))
+
+
+# ---------- PETICIONES PENDIENTES ----------
+
+def save_pending_request_sync(token, data):
+    c = connect().cursor()
+    now = time.time()
     c.execute(
-        "INSERT OR REPLACE INTO users (user_id, username, last_seen, total_downloads) "
-        "VALUES (?, ?, ?, COALESCE((SELECT total_downloads FROM users WHERE user_id = ?) + 1, 1))",
-        (user_id, username, datetime.now(), user_id)
+        "INSERT OR REPLACE INTO pending_requests (token, data, created_at) VALUES (?, ?, ?)",
+        (token, data, now)
     )
-    
+    # Limpiar las que nadie llegó a usar
+    c.execute("DELETE FROM pending_requests WHERE created_at < ?", (now - PENDING_REQUEST_TTL,))
     conn.commit()
-    conn.close()
 
-def get_user_stats(user_id):
-    conn = sqlite3.connect("history.db")
-    c = conn.cursor()
-    
-    c.execute("SELECT total_downloads FROM users WHERE user_id = ?", (user_id,))
+
+def claim_pending_request_sync(token):
+    """Toma la petición y la borra; si otro proceso se adelantó, devuelve None"""
+    c = connect().cursor()
+    c.execute(
+        "SELECT data FROM pending_requests WHERE token = ? AND created_at >= ?",
+        (token, time.time() - PENDING_REQUEST_TTL)
+    )
     result = c.fetchone()
-    
-    conn.close()
-    
-    return result[0] if result else 0
\ No newline at end of file
+    if not result:
+        return None
+
+    c.execute("DELETE FROM pending_requests WHERE token = ?", (token,))
+    claimed = c.rowcount == 1
+    conn.commit()
+    return result[0] if claimed else None
+
+
+def delete_pending_request_sync(token):
+    c = connect().cursor()
+    c.execute("DELETE FROM pending_requests WHERE token = ?", (token,))
+    conn.commit()
+
+
+async def save_pending_request(token, data):
+    await run_db(save_pending_request_sync, token, data)
+
+
+async def claim_pending_request(token):
+    return await run_db(claim_pending_request_sync, token)
+
+
+async def delete_pending_request(token):
+    await run_db(delete_pending_request_sync, token)
+
+
+# ---------- ANALÍTICA ----------
+
+def get_platform_stats_sync(since):
+    c = connect().cursor()
+    c.execute(
+        "SELECT platform, content_type, SUM(downloads) FROM daily_stats WHERE day >= ? "
+        "GROUP BY platform, content_type",
+        (since,)
+    )
+    return c.fetchall()
+
+
+def get_top_urls_sync(days, limit):
+    with connect() as c:
+        # Sin descargas desde el cambio de día la ventana aún no ha avanzado
+        expire_top_windows(c)
+        return c.execute(
+            "SELECT url, platform, downloads FROM top_urls WHERE days = ? "
+            "ORDER BY downloads DESC LIMIT ?",
+            (days, limit)
+        ).fetchall()
+
+
+async def get_platform_stats(days):
+    """[(plataforma, tipo, descargas)] de los últimos N días, desde los totales diarios"""
+    if flush_lock is not None:
+        await flush_with_retry(attempts=1)
+    return await run_db(get_platform_stats_sync, days_ago(days - 1))
+
+
+async def get_top_urls(days, limit=10):
+    """[(url, plataforma, descargas)] más descargados en los últimos N días (uno de TOP_URLS_WINDOWS)"""
+    if flush_lock is not None:
+        await flush_with_retry(attempts=1)
+    return await run_db(get_top_urls_sync, days, limit)
+
+
+# ---------- ESTADO DE LAS PLATAFORMAS ----------
+
+def save_upstream_state(platform, data, updated_at):
+    """Guarda el ritmo/cortacircuitos de una plataforma (con el siguiente lote)"""
+    enqueue_write("upstream", (platform, data, updated_at))
+
+
+def get_upstream_state_sync(platform):
+    c = connect().cursor()
+    c.execute("SELECT data, updated_at FROM upstream_state WHERE platform = ?", (platform,))
+    return c.fetchone()
+
+
+async def get_upstream_state(platform):
+    """Devuelve (data, updated_at) o None"""
+    return await run_db(get_upstream_state_sync, platform)
\ No newline at end of file
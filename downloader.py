@@ -1,187 +1,771 @@
-import yt_dlp
 import os
 import glob
 import asyncio
-from TikTokApi import TikTokApi
-from playwright.async_api import async_playwright
-import requests
-import re
-
-# Variable global para TikTok API
-tiktok_api = None
-
-async def init_tiktok_api():
-    """Inicializa la API de TikTok con manejo de errores"""
-    global tiktok_api
-    if tiktok_api is None:
-        try:
-            tiktok_api = TikTokApi()
-            await tiktok_api.create_sessions(num_sessions=1, sleep_after=3, headless=True)
-        except Exception as e:
-            print(f"Error al inicializar TikTokApi: {e}")
-            return None
-    return tiktok_api
+import copy
+import time
+import threading
+import shlex
+import shutil
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from config import (
+    DOWNLOAD_WORKERS, MAX_UPLOAD_SIZE, PROBE_CACHE_TTL, PROBE_CACHE_SIZE, PROBE_WORKERS,
+    CONCURRENT_FRAGMENTS, PARALLEL_AV_STREAMS, EXTERNAL_DOWNLOADER, EXTERNAL_DOWNLOADER_ARGS,
+    DOWNLOAD_TUNING, PHOTO_DUPLICATE_DISTANCE, ALBUM_IMAGE_MAX_SIZE
+)
+from http_client import fetch_iter
+from browser_pool import browser_pool
+from tiktok_pool import tiktok_pool
+from postprocess import prepare_video, prepare_image, run_ffmpeg
+from workspace import workspace
+from url_router import parse_link, normalize_host
+from metrics import timed, cache_result, error, DOWNLOADED_BYTES, ALBUM_SOURCE
+from ratelimit import upstream, classify, UpstreamUnavailable
+
+# Extensiones de video que pasan por el postprocesado
+VIDEO_EXTS = (".mp4", ".webm", ".mov", ".mkv")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+
+# URLs de las imágenes del álbum en la página (sin avatares), para el scraper de respaldo
+ALBUM_IMG_JS = """
+    () => [...new Set(
+        Array.from(document.querySelectorAll('img'))
+            .map(img => img.src)
+            .filter(src => src.includes('photomode') || (src.includes('tos-alisg') && !src.includes('avatar')))
+    )]
+"""
+
+# Máximo de imágenes de un álbum de TikTok (para estimar su tamaño)
+ALBUM_MAX_ITEMS = 35
+
+# Cada cuánto se recuentan las imágenes y cuánto se espera como mucho a que dejen de aparecer (s)
+ALBUM_SETTLE_INTERVAL = 0.5
+ALBUM_SETTLE_TIMEOUT = 5
+
+# Hilos dedicados para yt-dlp (acotados, en lugar del executor por defecto)
+executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="ytdlp")
+
+# Hilos para sondear formatos: un sondeo nunca espera a que acabe una descarga
+probe_executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="ytdlp-probe")
+
+# Hilos para bajar a la vez el video y el audio de cada descarga
+stream_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS * 2, thread_name_prefix="ytdlp-av")
 
-async def download_tiktok_album_api(url):
+# Como mucho un aviso de progreso por descarga en este intervalo (segundos)
+PROGRESS_MIN_INTERVAL = 0.5
+
+# Metadatos ya extraídos por contenido: clave -> (momento, info)
+probe_cache = OrderedDict()
+
+def make_cache_key(url, quality=None):
     """
-    Descarga álbumes de TikTok usando TikTokApi oficial corrigiendo el error de URL
+    Genera una clave estable para el contenido: plataforma e ID canónico si se
+    reconoce, si no la URL normalizada (sin query ni fragmento), más la calidad pedida
     """
-    try:
-        # Extraer ID del post para nombres de archivo
-        match = re.search(r'/photo/(\d+)', url)
-        post_id = match.group(1) if match else "tiktok_post"
-        
-        api = await init_tiktok_api()
-        if not api:
-            return await download_tiktok_album_fallback(url)
-        
+    link = parse_link(url)
+    if link:
+        content_id = link.key
+    else:
+        parsed = urlparse(url.strip() if "://" in url else f"https://{url.strip()}")
+        content_id = f"{normalize_host(parsed.netloc)}{parsed.path.rstrip('/')}"
+    
+    return f"{content_id}:{quality or 'default'}"
+
+def is_album(url):
+    link = parse_link(url)
+    return link is not None and link.kind == "album"
+
+async def get_tiktok_album_items_api(url, workdir):
+    """
+    Obtiene las imágenes de un álbum de TikTok usando TikTokApi oficial corrigiendo el error de URL.
+    Devuelve una lista de (url_imagen, ruta_destino) dentro de workdir
+    """
+    # Extraer ID del post para nombres de archivo
+    link = parse_link(url)
+    post_id = link.content_id if link else "tiktok_post"
+    
+    # Sesión del pool (se libera antes de bajar las imágenes)
+    async with tiktok_pool.lease() as api:
         # CORRECCIÓN: Usar url=url en lugar de id=post_id para evitar el error de video.info()
         video = api.video(url=url)
         video_data = await video.info()
-        
-        downloaded_files = []
-        os.makedirs("media", exist_ok=True)
-        
-        # Estructura de datos de TikTok para álbumes (imagePost)
-        if 'imagePost' in video_data and 'images' in video_data['imagePost']:
-            images = video_data['imagePost']['images']
+    
+    # Estructura de datos de TikTok para álbumes (imagePost)
+    if 'imagePost' not in video_data or 'images' not in video_data['imagePost']:
+        return []
+    
+    # Obtener la URL (usualmente la última de la lista es mejor calidad)
+    return [
+        (img['imageURL']['urlList'][-1], os.path.join(workdir, f"tiktok_album_{post_id}_{idx}.jpg"))
+        for idx, img in enumerate(video_data['imagePost']['images'])
+    ]
+
+async def get_tiktok_album_items_fallback(url, workdir):
+    """
+    Método alternativo usando Playwright para scraping directo (más lento pero seguro)
+    """
+    link = parse_link(url)
+    post_id = link.content_id if link else "fb"
+    
+    # Contexto del navegador ya arrancado (imágenes, fuentes y media bloqueadas)
+    async with browser_pool.lease() as context:
+        page = await context.new_page()
+        try:
+            await page.goto(url, wait_until='domcontentloaded', timeout=30000)
+            # Esperar a la primera imagen del álbum (no basta con un avatar) en lugar de una pausa fija
+            await page.wait_for_function(f"() => ({ALBUM_IMG_JS})().length > 0", timeout=15000)
             
-            for idx, img in enumerate(images):
-                # Obtener la URL (usualmente la última de la lista es mejor calidad)
-                img_url = img['imageURL']['urlList'][-1]
-                
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                    'Referer': 'https://www.tiktok.com/'
-                }
-                
-                response = requests.get(img_url, headers=headers, timeout=15)
-                
-                if response.status_code == 200:
-                    filename = f"media/tiktok_album_{post_id}_{idx}.jpg"
-                    with open(filename, 'wb') as f:
-                        f.write(response.content)
-                    downloaded_files.append(filename)
-        
+            # El carrusel va añadiendo diapositivas: esperar a que el número deje de
+            # crecer durante dos recuentos seguidos
+            img_urls = await page.evaluate(ALBUM_IMG_JS)
+            deadline = time.monotonic() + ALBUM_SETTLE_TIMEOUT
+            stable = 0
+            while stable < 2 and time.monotonic() < deadline:
+                await asyncio.sleep(ALBUM_SETTLE_INTERVAL)
+                current = await page.evaluate(ALBUM_IMG_JS)
+                stable = stable + 1 if len(current) <= len(img_urls) else 0
+                img_urls = current if len(current) > len(img_urls) else img_urls
+        finally:
+            await page.close()
+    
+    # Limitar a 20 imágenes para evitar spam y asegurar unicidad (manteniendo el orden)
+    unique_urls = list(dict.fromkeys(img_urls))
+    return [
+        (img_url, os.path.join(workdir, f"tiktok_fb_{post_id}_{idx}.jpg"))
+        for idx, img_url in enumerate(unique_urls[:20])
+    ]
+
+async def download_tiktok_album(url, workdir):
+    """
+    Descarga un álbum de TikTok entregando cada imagen en cuanto está en disco.
+    Primero con TikTokApi; si falla o no baja nada, con el scraper de respaldo
+    """
+    # yt-dlp se mide en download_sync; aquí solo el álbum. El reloj se para en cada
+    # yield: el postprocesado y la subida que haga el consumidor no cuentan
+    with timed("download") as clock:
+        headers = {'Referer': 'https://www.tiktok.com/'}
+    
+        # Con TikTok limitando no se intenta nada (ni el navegador de respaldo)
+        await upstream.acquire("TikTok")
+        try:
+            items = await get_tiktok_album_items_api(url, workdir)
+        except Exception as e:
+            print(f"Error con TikTokApi ({e}), intentando método alternativo...")
+            error("album", "tiktok_api")
+            await upstream.record("TikTok", classify(e))
+            items = []
+        else:
+            await upstream.record("TikTok", "ok" if items else None)
+    
+        found = False
+        async for file in fetch_iter(items, headers=headers):
+            found = True
+            DOWNLOADED_BYTES.labels(platform="TikTok").inc(os.path.getsize(file))
+            with clock.paused():
+                yield file
+    
         # Si no se bajó nada, intentar fallback
-        if not downloaded_files:
-            return await download_tiktok_album_fallback(url)
-            
-        return downloaded_files, "TikTok"
+        if found:
+            ALBUM_SOURCE.labels(path="tiktok_api").inc()
+            return
     
-    except Exception as e:
-        print(f"Error con TikTokApi ({e}), intentando método alternativo...")
-        return await download_tiktok_album_fallback(url)
+        await upstream.acquire("TikTok")
+        try:
+            items = await get_tiktok_album_items_fallback(url, workdir)
+        except Exception as e:
+            print(f"Error en método fallback: {e}")
+            error("album", "tiktok_fallback")
+            await upstream.record("TikTok", classify(e))
+            return
+        await upstream.record("TikTok", "ok" if items else None)
+    
+        # Los iconos que se cuelen los descarta prepare_files por dimensiones
+        async for file in fetch_iter(items, headers=headers):
+            found = True
+            DOWNLOADED_BYTES.labels(platform="TikTok").inc(os.path.getsize(file))
+            with clock.paused():
+                yield file
+    
+        if found:
+            ALBUM_SOURCE.labels(path="tiktok_fallback").inc()
+        else:
+            error("album", "tiktok_fallback")
+
+def detect_platform(url):
+    """Plataforma de la URL ("" si no se reconoce)"""
+    link = parse_link(url)
+    return link.platform if link else ""
+
+# ---------- SONDEO DE FORMATOS ----------
+
+def probe_sync(url):
+    """Extrae los metadatos con yt-dlp sin descargar ni procesar formatos"""
+    # yt-dlp se importa al primer uso (en el hilo de descarga): cargar
+    # todos sus extractores tarda y no hace falta para arrancar el bot
+    import yt_dlp
+    with yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True}) as ydl:
+        return ydl.extract_info(url, download=False, process=False)
 
-async def download_tiktok_album_fallback(url):
+def get_probed(url):
+    """Metadatos sondeados y vigentes para la URL, o None"""
+    cached = probe_cache.get(make_cache_key(url))
+    if cached and time.monotonic() - cached[0] < PROBE_CACHE_TTL:
+        return cached[1]
+    return None
+
+async def probe(url):
     """
-    Método alternativo usando Playwright para scraping directo (más lento pero seguro)
+    Sondea la URL (una sola vez por contenido mientras siga vigente).
+    Solo se guardan videos individuales, que son los que se pueden reutilizar al descargar
     """
+    info = get_probed(url)
+    cache_result("probe", info is not None)
+    if info:
+        return info
+    
+    loop = asyncio.get_running_loop()
+    platform = detect_platform(url)
+    await upstream.acquire(platform)
     try:
-        match = re.search(r'/photo/(\d+)', url)
-        post_id = match.group(1) if match else "fb"
-        downloaded_files = []
+        with timed("probe"):
+            info = await loop.run_in_executor(probe_executor, probe_sync, url)
+    except Exception as e:
+        error("probe", platform or "generic")
+        await upstream.record(platform, classify(e))
+        raise
+    await upstream.record(platform, "ok")
+    if info.get("_type", "video") != "video":
+        return None
+    
+    probe_cache[make_cache_key(url)] = (time.monotonic(), info)
+    if len(probe_cache) > PROBE_CACHE_SIZE:
+        probe_cache.popitem(last=False)
+    return info
+
+def estimate_size(fmt, duration):
+    """Tamaño en bytes del formato (real, aproximado o por bitrate)"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if not size and fmt.get("tbr") and duration:
+        size = fmt["tbr"] * 1000 / 8 * duration
+    return size
+
+def expected_size(url, quality):
+    """Tamaño aproximado de la descarga según el sondeo (None si no se sabe)"""
+    if is_album(url):
+        # Las imágenes no se conocen hasta bajar la lista: contar con el álbum más largo
+        return ALBUM_MAX_ITEMS * ALBUM_IMAGE_MAX_SIZE
+    info = get_probed(url)
+    if not info or not quality or not quality.startswith("fmt:"):
+        return None
+    ids = quality[len("fmt:"):].split("+")
+    sizes = [
+        estimate_size(f, info.get("duration"))
+        for f in info.get("formats") or [] if f.get("format_id") in ids
+    ]
+    if len(sizes) != len(ids) or not all(sizes):
+        return None
+    return sum(sizes)
+
+def format_options(info, limit=MAX_UPLOAD_SIZE, max_options=4):
+    """
+    Calidades reales que caben en el límite de subida, de mayor a menor:
+    lista de (altura, formato para yt-dlp, tamaño estimado)
+    """
+    duration = info.get("duration")
+    formats = info.get("formats") or []
+    
+    # Mejor audio suelto para combinar con los videos sin audio (m4a primero, por compatibilidad)
+    audios = [
+        f for f in formats
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+        and estimate_size(f, duration)
+    ]
+    best_audio = max(
+        audios, key=lambda f: (f.get("ext") == "m4a", f.get("abr") or f.get("tbr") or 0), default=None
+    )
+    
+    best_by_height = {}
+    for f in formats:
+        if f.get("vcodec") == "none" or not f.get("height"):
+            continue
+        size = estimate_size(f, duration)
+        if not size:
+            continue
+        if f.get("acodec") == "none":
+            # Solo video: necesita el audio aparte
+            if not best_audio:
+                continue
+            spec = f"{f['format_id']}+{best_audio['format_id']}"
+            size += estimate_size(best_audio, duration)
+        else:
+            spec = f["format_id"]
         
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
-            
-            await page.set_extra_http_headers({
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            })
-            
-            await page.goto(url, wait_until='networkidle', timeout=30000)
-            await page.wait_for_timeout(3000) # Esperar renderizado
-            
-            # Selector mejorado para imágenes de álbum
-            img_urls = await page.evaluate("""
-                () => {
-                    const images = Array.from(document.querySelectorAll('img'));
-                    return images
-                        .map(img => img.src)
-                        .filter(src => src.includes('photomode') || (src.includes('tos-alisg') && !src.includes('avatar')));
-                }
-            """)
-            
-            await browser.close()
-            
-            os.makedirs("media", exist_ok=True)
-            headers = {'User-Agent': 'Mozilla/5.0', 'Referer': 'https://www.tiktok.com/'}
-            
-            # Limitar a 20 imágenes para evitar spam y asegurar unicidad
-            unique_urls = list(set(img_urls))
-            for idx, img_url in enumerate(unique_urls[:20]):
-                try:
-                    res = requests.get(img_url, headers=headers, timeout=10)
-                    if res.status_code == 200 and len(res.content) > 10000: # Ignorar iconos pequeños
-                        fn = f"media/tiktok_fb_{post_id}_{idx}.jpg"
-                        with open(fn, 'wb') as f:
-                            f.write(res.content)
-                        downloaded_files.append(fn)
-                except:
-                    continue
+        if size > limit:
+            continue
         
-        return downloaded_files, "TikTok"
-    except Exception as e:
-        print(f"Error en método fallback: {e}")
-        return [], "TikTok"
+        rank = (f.get("ext") == "mp4", f.get("tbr") or 0)
+        current = best_by_height.get(f["height"])
+        if current is None or rank > current[0]:
+            best_by_height[f["height"]] = (rank, spec, size)
+    
+    heights = sorted(best_by_height, reverse=True)[:max_options]
+    return [(h, best_by_height[h][1], best_by_height[h][2]) for h in heights]
+
+def tuning_opts(platform):
+    """Opciones de velocidad de yt-dlp para la plataforma (ver DOWNLOAD_TUNING)"""
+    tuning = DOWNLOAD_TUNING.get(platform, {})
+    opts = {"concurrent_fragment_downloads": tuning.get("fragments", CONCURRENT_FRAGMENTS)}
+    if tuning.get("chunk_size"):
+        opts["http_chunk_size"] = tuning["chunk_size"]
+    external = tuning.get("external_downloader", EXTERNAL_DOWNLOADER)
+    if external and shutil.which(external):
+        opts["external_downloader"] = {"default": external}
+        if EXTERNAL_DOWNLOADER_ARGS:
+            opts["external_downloader_args"] = {external: shlex.split(EXTERNAL_DOWNLOADER_ARGS)}
+    return opts
+
+def download_av_sync(info, streams, ydl_opts, workdir, progress_hook):
+    """
+    Baja el video y el audio elegidos en dos hilos a la vez y los une sin
+    recodificar. yt-dlp los bajaría uno detrás de otro. Devuelve la ruta final
+    """
+    state = [{} for _ in streams]
+
+    def stream_hook(idx, d):
+        state[idx] = d
+        if d.get("status") == "finished":
+            # Cada flujo avisa de su final por separado para contar sus propios bytes
+            progress_hook(d)
+            return
+        # Progreso combinado de los dos flujos
+        totals = [s.get("total_bytes") or s.get("total_bytes_estimate") for s in state]
+        progress_hook({
+            "status": d.get("status"),
+            "downloaded_bytes": sum(s.get("downloaded_bytes") or 0 for s in state),
+            "total_bytes": sum(totals) if all(totals) else None,
+            "speed": sum(s.get("speed") or 0 for s in state) or None,
+            "eta": max((s.get("eta") or 0 for s in state), default=None),
+        })
 
-def download_sync(url, quality="best"):
-    """Versión síncrona para yt-dlp (Instagram/YouTube/TikTok Video)"""
-    os.makedirs("media", exist_ok=True)
+    def fetch(idx, fmt):
+        paths = []
+        opts = {
+            **ydl_opts,
+            "format": fmt["format_id"],
+            "outtmpl": os.path.join(workdir, "%(id)s.f%(format_id)s.%(ext)s"),
+            "post_hooks": [paths.append],
+            "progress_hooks": [lambda d: stream_hook(idx, d)],
+        }
+        opts.pop("merge_output_format", None)
+        import yt_dlp
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            ydl.process_ie_result(copy.deepcopy(info), download=True)
+        return paths[0]
+
+    futures = [stream_executor.submit(fetch, idx, fmt) for idx, fmt in enumerate(streams)]
+    # Esperar a los dos antes de propagar un error, para no dejar un hilo escribiendo
+    errors = [f.exception() for f in futures]
+    paths = [f.result() for f in futures if f.exception() is None]
+    try:
+        if any(errors):
+            raise next(e for e in errors if e)
+        out = os.path.join(workdir, f"{info['id']}.mp4")
+        args = []
+        for path in paths:
+            args += ["-i", path]
+        run_ffmpeg([*args, "-map", "0", "-map", "1", "-c", "copy", "-movflags", "+faststart"], out)
+        return out
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+def download_sync(url, quality="best", on_file=None, workdir="media", on_progress=None, cancel=None):
+    """
+    Versión síncrona para yt-dlp (Instagram/YouTube/TikTok Video).
+    on_file(ruta) se llama (desde el hilo de descarga) con cada archivo terminado.
+    on_progress(dict) recibe bytes descargados, total, velocidad y ETA.
+    Los archivos se guardan en workdir (una carpeta propia por descarga).
+    Si se activa el evento cancel, la descarga se aborta y se borra lo descargado
+    """
+    import yt_dlp
+    os.makedirs(workdir, exist_ok=True)
     downloaded_files = []
-    platform = ""
+    platform = detect_platform(url)
     
     ydl_opts = {
-        "outtmpl": "media/%(id)s_%(autonumber)s.%(ext)s",
+        "outtmpl": os.path.join(workdir, "%(id)s_%(autonumber)s.%(ext)s"),
         "quiet": True,
         "no_warnings": True,
         "noplaylist": False,
+        **tuning_opts(platform),
     }
     
-    if "tiktok.com" in url:
-        platform = "TikTok"
-        ydl_opts["format"] = "best"
-    elif "instagram.com" in url:
-        platform = "Instagram"
+    if quality and quality.startswith("fmt:"):
+        # Formato concreto elegido tras el sondeo
+        ydl_opts["format"] = quality[len("fmt:"):]
+        ydl_opts["merge_output_format"] = "mp4"
+    elif platform in ("TikTok", "Instagram"):
         ydl_opts["format"] = "best"
-    elif "youtube.com" in url or "youtu.be" in url:
-        platform = "YouTube"
+    elif platform == "YouTube":
         if quality == "best":
             ydl_opts["format"] = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
         else:
-            ydl_opts["format"] = "worst[ext=mp4]/worst"
+            ydl_opts["format"] = (
+                "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]"
+                "/best[height<=480][ext=mp4]/best[height<=480]/worst"
+            )
         ydl_opts["merge_output_format"] = "mp4"
 
-    def progress_hook(d):
-        if d["status"] == "finished":
-            file = d.get("filename")
-            if file and file not in downloaded_files:
-                downloaded_files.append(file)
+    def post_hook(file):
+        # Ruta final de cada video (después de fusionar audio/video)
+        if file and file not in downloaded_files:
+            downloaded_files.append(file)
+            if on_file:
+                on_file(file)
     
+    last_progress = 0
+
+    def progress_hook(d):
+        nonlocal last_progress
+        # Lanzar aquí detiene yt-dlp en el siguiente bloque y libera el hilo
+        if cancel is not None and cancel.is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+        if d.get("status") == "finished":
+            # Bytes bajados de la plataforma, antes de fusionar o postprocesar
+            DOWNLOADED_BYTES.labels(platform=platform or "Video").inc(
+                d.get("downloaded_bytes") or d.get("total_bytes") or 0
+            )
+        if not on_progress or d.get("status") != "downloading":
+            return
+        now = time.monotonic()
+        if now - last_progress < PROGRESS_MIN_INTERVAL:
+            return
+        last_progress = now
+        on_progress({
+            "downloaded": d.get("downloaded_bytes") or 0,
+            "total": d.get("total_bytes") or d.get("total_bytes_estimate"),
+            "speed": d.get("speed"),
+            "eta": d.get("eta"),
+        })
+
+    ydl_opts["post_hooks"] = [post_hook]
     ydl_opts["progress_hooks"] = [progress_hook]
     
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        with timed("download"), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            probed = get_probed(url)
+            selected = None
+            if probed and PARALLEL_AV_STREAMS:
+                # Resolver el formato sin descargar para ver si son dos flujos
+                selected = ydl.process_ie_result(copy.deepcopy(probed), download=False)
+            if selected and len(selected.get("requested_formats") or []) == 2:
+                post_hook(download_av_sync(
+                    probed, selected["requested_formats"], ydl_opts, workdir, progress_hook
+                ))
+                info = selected
+            elif probed:
+                # Reutilizar la extracción del sondeo en lugar de repetirla
+                info = ydl.process_ie_result(copy.deepcopy(probed), download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
             if not downloaded_files:
                 # Caso especial: algunos archivos cambian de nombre al finalizar
-                pattern = f"media/{info.get('id', '*')}*"
+                pattern = os.path.join(workdir, f"{info.get('id', '*')}*")
                 downloaded_files = glob.glob(pattern)
             if not platform:
                 platform = info.get("extractor_key", "Video")
+    except yt_dlp.utils.DownloadCancelled:
+        # Borrar lo que se llegó a bajar (los .part se van con la carpeta de la descarga)
+        for file in downloaded_files:
+            if os.path.exists(file):
+                os.remove(file)
+        return [], "Cancelado"
     except Exception as e:
         print(f"Error en yt-dlp: {e}")
+        error("download", platform or "generic")
+        # Bloqueos y caídas de la plataforma llegan al limitador de ytdlp_files
+        if classify(e):
+            raise
         return [], "Error"
     
     return downloaded_files, platform
 
-async def download(url, quality="best"):
-    """Función principal de entrada"""
-    # Detectar si es álbum de fotos de TikTok
-    if "tiktok.com" in url and "/photo/" in url:
-        return await download_tiktok_album_api(url)
+async def fetch_stream(url, quality, workdir, on_progress=None, cancel=None):
+    """
+    Descarga real como generador asíncrono: entrega (archivo, plataforma)
+    en cuanto cada archivo termina y está postprocesado, sin esperar al resto.
+    on_progress se llama en el loop con el progreso de yt-dlp
+    """
+    platform = detect_platform(url) or "Video"
+    
+    # Álbum de fotos de TikTok o, para todo lo demás, yt-dlp
+    if is_album(url):
+        files = download_tiktok_album(url, workdir)
+    else:
+        files = ytdlp_files(url, quality, workdir, platform, on_progress, cancel)
+    
+    async for file in prepare_files(files, cancel):
+        yield file, platform
+
+async def ytdlp_files(url, quality, workdir, platform, on_progress=None, cancel=None):
+    """
+    yt-dlp en un hilo separado; archivos y progreso llegan al loop por
+    call_soon_threadsafe. Antes espera turno en el limitador de la plataforma
+    """
+    await upstream.acquire(platform)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    
+    def on_file(file):
+        loop.call_soon_threadsafe(queue.put_nowait, file)
+    
+    def progress_threadsafe(progress):
+        loop.call_soon_threadsafe(on_progress, progress)
+    
+    future = loop.run_in_executor(
+        executor, download_sync, url, quality, on_file, workdir,
+        progress_threadsafe if on_progress else None, cancel
+    )
+    future.add_done_callback(lambda _: queue.put_nowait(None))
+    
+    yielded = []
+    finished = False
+    try:
+        while (file := await queue.get()) is not None:
+            yielded.append(file)
+            yield file
+        
+        # Archivos encontrados al final (p. ej. por el glob de respaldo)
+        try:
+            files, _ = await future
+        except Exception as e:
+            outcome = classify(e)
+            await upstream.record(platform, outcome)
+            if outcome == "throttled":
+                raise UpstreamUnavailable(platform, upstream.retry_after(platform)) from e
+            raise
+        await upstream.record(platform, "ok" if files else None)
+        for file in files:
+            if file not in yielded:
+                yielded.append(file)
+                yield file
+        finished = True
+    
+    finally:
+        if not finished:
+            # Cancelada o abandonada: el hilo se detiene en el siguiente bloque
+            # (cancel activado); borrar lo que terminó y nadie llegó a recibir
+            try:
+                files, _ = await future
+            except Exception:
+                files = []
+            await upstream.record(platform, None)
+            for file in files:
+                if file not in yielded and os.path.exists(file):
+                    os.remove(file)
+
+async def prepare_files(files, cancel=None):
+    """
+    Postprocesa en paralelo los archivos según van llegando (videos con ffmpeg,
+    imágenes con Pillow, cada uno en su pool de procesos) y los entrega en
+    orden, quitando lo que no es una foto y las diapositivas repetidas
+    """
+    pending = deque()
+    hashes = []
+    
+    def accept(result):
+        parts, image_hash = result
+        if image_hash is not None:
+            if any(bin(image_hash ^ seen).count("1") <= PHOTO_DUPLICATE_DISTANCE for seen in hashes):
+                for part in parts:
+                    os.remove(part)
+                return []
+            hashes.append(image_hash)
+        return parts
+    
+    finished = False
+    try:
+        async for file in files:
+            pending.append(asyncio.ensure_future(postprocess_file(file)))
+            while pending and pending[0].done():
+                for part in accept(pending.popleft().result()):
+                    yield part
+        while pending:
+            for part in accept(await pending.popleft()):
+                yield part
+        finished = True
+    
+    finally:
+        for task in pending:
+            task.cancel()
+        if not finished and cancel is not None:
+            cancel.set()
+        await files.aclose()
+
+async def postprocess_file(file):
+    """
+    Ajusta un archivo para Telegram: videos al límite de subida (remux,
+    recodificación o partes) y fotos a sus límites. Devuelve (partes, hash
+    perceptual de la foto o None)
+    """
+    if file.endswith(VIDEO_EXTS):
+        with timed("postprocess"):
+            return await prepare_video(file), None
+    if file.endswith(IMAGE_EXTS):
+        with timed("postprocess"):
+            path, image_hash = await prepare_image(file)
+        return ([path] if path else []), image_hash
+    return [file], None
+
+# ---------- DESCARGAS COMPARTIDAS ----------
+
+# Descargas en curso por clave de contenido, y a qué descarga pertenece cada archivo
+inflight = {}
+file_owners = {}
+
+class SharedDownload:
+    """
+    Una descarga en curso compartida por todos los que piden el mismo
+    contenido a la vez. Cada archivo se borra cuando todos los que lo
+    recibieron lo han liberado con release_file()
+    """
+    def __init__(self, key, platform):
+        self.key = key
+        self.workdir = None  # carpeta propia en el workspace
+        self.platform = platform
+        self.files = []
+        self.refs = {}  # archivo -> consumidores que aún no lo liberaron
+        self.cursors = {}  # consumidor -> índice del siguiente archivo que recibirá
+        self.finished = False
+        self.error = None
+        self.changed = asyncio.Condition()
+        self.task = None
+        self.cancel = threading.Event()
+        self.progress = None  # último progreso conocido
+        self.listeners = set()
+
+    async def produce(self, url, quality):
+        try:
+            self.workdir = workspace.create(expected_size(url, quality))
+            async for file, platform in fetch_stream(url, quality, self.workdir, self.publish, self.cancel):
+                self.files.append(file)
+                self.refs[file] = 0
+                self.platform = platform
+                file_owners[file] = self
+                async with self.changed:
+                    self.changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            # A partir de aquí nadie nuevo se une: la siguiente petición descarga de nuevo
+            self.finished = True
+            if inflight.get(self.key) is self:
+                del inflight[self.key]
+            async with self.changed:
+                self.changed.notify_all()
+            self.collect()
+
+    def publish(self, progress):
+        self.progress = progress
+        for listener in list(self.listeners):
+            listener(progress)
+
+    def abort(self):
+        """Detiene la descarga (cuando ya no queda nadie esperándola)"""
+        self.cancel.set()
+        if inflight.get(self.key) is self:
+            del inflight[self.key]
+        if self.task is not None:
+            self.task.cancel()
+
+    def collect(self):
+        """Borra los archivos que ya nadie va a usar"""
+        if not self.finished:
+            return
+        # Ningún consumidor activo puede recibir archivos anteriores a este índice
+        lowest = min(self.cursors.values(), default=len(self.files))
+        for file in self.files[:lowest]:
+            if file in file_owners and self.refs[file] <= 0:
+                del file_owners[file]
+                if os.path.exists(file):
+                    os.remove(file)
+        # Sin archivos pendientes: fuera la carpeta con lo que quede (.part, originales)
+        if self.workdir and not any(file_owners.get(file) is self for file in self.files):
+            workspace.remove(self.workdir)
+            self.workdir = None
+
+def release_file(file):
+    """
+    Indica que el llamante ya terminó con un archivo recibido de download()
+    o download_stream(); se borra cuando nadie más lo necesita
+    """
+    job = file_owners.get(file)
+    if job is None:
+        if os.path.exists(file):
+            os.remove(file)
+        return
+    job.refs[file] -= 1
+    job.collect()
+
+async def download_stream(url, quality="best", on_progress=None):
+    """
+    Generador asíncrono de (archivo, plataforma) según van terminando.
+    Si ya hay una descarga idéntica en curso, se comparte en lugar de repetirla.
+    on_progress(dict) recibe el progreso de la descarga.
+    Cada archivo recibido debe liberarse con release_file(); si el consumidor
+    se detiene antes de tiempo y nadie más espera, la descarga se aborta
+    """
+    key = make_cache_key(url, quality)
+    job = inflight.get(key)
+    if job is None:
+        job = SharedDownload(key, detect_platform(url) or "Video")
+        inflight[key] = job
+        job.task = asyncio.create_task(job.produce(url, quality))
     
-    # Para todo lo demás usar yt-dlp en un hilo separado
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, download_sync, url, quality)
\ No newline at end of file
+    consumer = object()
+    job.cursors[consumer] = 0
+    if on_progress:
+        job.listeners.add(on_progress)
+        if job.progress:
+            on_progress(job.progress)
+    try:
+        while True:
+            async with job.changed:
+                await job.changed.wait_for(
+                    lambda: job.cursors[consumer] < len(job.files) or job.finished
+                )
+            idx = job.cursors[consumer]
+            if idx < len(job.files):
+                file = job.files[idx]
+                job.refs[file] += 1
+                job.cursors[consumer] = idx + 1
+                yield file, job.platform
+            else:
+                break
+        if job.error and not job.files:
+            raise job.error
+    finally:
+        job.listeners.discard(on_progress)
+        del job.cursors[consumer]
+        if not job.finished and not job.cursors:
+            job.abort()
+        job.collect()
+
+async def download(url, quality="best", on_progress=None):
+    """
+    Función principal de entrada: devuelve (archivos, plataforma) al terminar.
+    Cada archivo debe liberarse con release_file()
+    """
+    files = []
+    platform = detect_platform(url) or "Video"
+    try:
+        async for file, platform in download_stream(url, quality, on_progress):
+            files.append(file)
+    except BaseException:
+        # Cancelada o fallida: soltar lo ya recibido
+        for file in files:
+            release_file(file)
+        raise
+    return files, platform
\ No newline at end of file
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import random
+import httpx
+from config import HTTP_MAX_CONNECTIONS, HTTP_RETRIES, IMAGE_FETCH_CONCURRENCY
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+}
+
+# Códigos que vale la pena reintentar
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Cliente compartido con conexiones keep-alive
+_client = None
+
+
+class RetryableStatus(Exception):
+    pass
+
+
+def get_client():
+    """Devuelve el cliente HTTP compartido (lo crea la primera vez)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            timeout=httpx.Timeout(15.0, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS
+            ),
+            follow_redirects=True,
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def fetch_to_file(url, path, headers=None, retries=HTTP_RETRIES):
+    """
+    Descarga url en streaming a path, con reintentos y backoff exponencial.
+    Devuelve path, o None si falla
+    """
+    client = get_client()
+    tmp_path = f"{path}.part"
+
+    for attempt in range(retries + 1):
+        try:
+            async with client.stream("GET", url, headers=headers) as response:
+                if response.status_code in RETRY_STATUS:
+                    raise RetryableStatus(response.status_code)
+                if response.status_code != 200:
+                    return None
+
+                with open(tmp_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(64 * 1024):
+                        f.write(chunk)
+
+            os.replace(tmp_path, path)
+            return path
+
+        except (httpx.TransportError, RetryableStatus) as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if attempt == retries:
+                print(f"Error descargando {url}: {e}")
+                return None
+            await asyncio.sleep(0.5 * 2 ** attempt + random.uniform(0, 0.3))
+
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            print(f"Error descargando {url}: {e}")
+            return None
+
+
+async def fetch_iter(items, headers=None, concurrency=IMAGE_FETCH_CONCURRENCY):
+    """
+    Descarga en paralelo una lista de (url, path) con un máximo de
+    descargas simultáneas. Entrega cada ruta en cuanto está lista, en orden
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_one(url, path):
+        async with semaphore:
+            return await fetch_to_file(url, path, headers=headers)
+
+    tasks = [asyncio.create_task(fetch_one(url, path)) for url, path in items]
+    try:
+        for task in tasks:
+            path = await task
+            if path:
+                yield path
+    finally:
+        # Si el consumidor se detiene, no seguir descargando
+        for task in tasks:
+            task.cancel()
\ No newline at end of file
@@ -0,0 +1,74 @@
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Desde validar el link (milisegundos) hasta descargas y subidas largas (minutos)
+STAGE_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds", "Duración de cada etapa del proceso",
+    ["stage"], buckets=STAGE_BUCKETS
+)
+DOWNLOADED_BYTES = Counter("bot_downloaded_bytes_total", "Bytes descargados", ["platform"])
+UPLOADED_BYTES = Counter("bot_uploaded_bytes_total", "Bytes subidos a Telegram", ["platform"])
+CACHE_REQUESTS = Counter(
+    "bot_cache_requests_total", "Consultas a las cachés (media, probe, stats)", ["cache", "result"]
+)
+ERRORS = Counter("bot_errors_total", "Errores por etapa y origen (extractor o ruta)", ["stage", "source"])
+ALBUM_SOURCE = Counter("bot_tiktok_album_total", "Álbumes de TikTok por ruta que los resolvió", ["path"])
+UPSTREAM_RATE = Gauge("bot_upstream_rate", "Extracciones por segundo permitidas por plataforma", ["platform"])
+UPSTREAM_BREAKER = Gauge(
+    "bot_upstream_breaker", "Cortacircuitos por plataforma (0 cerrado, 1 de prueba, 2 abierto)", ["platform"]
+)
+UPSTREAM_REJECTED = Counter(
+    "bot_upstream_rejected_total", "Peticiones rechazadas sin llegar a la plataforma", ["platform"]
+)
+READY = Gauge("bot_ready", "1 cuando el bot ya recibe actualizaciones (polling o webhook)")
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Desde que se cargó el bot hasta que estuvo listo")
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Trabajos esperando en la cola de descargas")
+ACTIVE_WORKERS = Gauge("bot_active_workers", "Trabajos de descarga en ejecución")
+
+
+class Stopwatch:
+    """Reloj que se puede pausar: cuenta solo los tramos en marcha"""
+
+    def __init__(self):
+        self.elapsed = 0
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def paused(self):
+        self.elapsed += time.perf_counter() - self.started
+        try:
+            yield
+        finally:
+            self.started = time.perf_counter()
+
+    def total(self):
+        return self.elapsed + time.perf_counter() - self.started
+
+
+@contextmanager
+def timed(stage):
+    """
+    Mide lo que tarda el bloque (también con await dentro) como la etapa indicada.
+    Lo que vaya dentro de clock.paused() no cuenta (p. ej. el yield de un generador)
+    """
+    clock = Stopwatch()
+    try:
+        yield clock
+    finally:
+        STAGE_SECONDS.labels(stage=stage).observe(clock.total())
+
+
+def cache_result(cache, hit):
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def error(stage, source):
+    ERRORS.labels(stage=stage, source=source or "unknown").inc()
+
+
+def start_metrics_server(port, addr):
+    """Expone /metrics en addr:port (servidor HTTP en un hilo aparte)"""
+    start_http_server(port, addr=addr)
\ No newline at end of file
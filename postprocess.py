@@ -0,0 +1,233 @@
+import os
+import json
+import math
+import asyncio
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, UnidentifiedImageError
+from config import (
+    MAX_UPLOAD_SIZE, POSTPROCESS_WORKERS, MIN_VIDEO_BITRATE, AUDIO_BITRATE,
+    IMAGE_WORKERS, PHOTO_MAX_SIDE, PHOTO_MAX_BYTES, PHOTO_MIN_SIDE, PHOTO_JPEG_QUALITY
+)
+
+# Procesos nuevos en lugar de fork: el bot ya tiene hilos (sqlite, yt-dlp, métricas)
+# y hacer fork de un proceso con hilos puede bloquearse, además de copiar su memoria
+spawn = multiprocessing.get_context("spawn")
+
+# ffmpeg corre en procesos aparte para no bloquear el bot
+process_pool = ProcessPoolExecutor(max_workers=POSTPROCESS_WORKERS, mp_context=spawn)
+
+# Pillow usa CPU de verdad: un proceso por núcleo, aparte de los de ffmpeg
+image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=spawn)
+
+# Relación de aspecto máxima que Telegram acepta para una foto
+MAX_PHOTO_RATIO = 20
+
+# Margen para contenedor, cabeceras y desviaciones del bitrate
+SIZE_MARGIN = 0.92
+
+# Veces que se vuelve a cortar una parte que sigue pasándose del límite
+MAX_SPLIT_DEPTH = 3
+
+
+def run_ffmpeg(args, out):
+    """Ejecuta ffmpeg; si falla, borra la salida a medias"""
+    try:
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args, out],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+    except Exception:
+        if os.path.exists(out):
+            os.remove(out)
+        raise
+
+
+def get_duration(path):
+    """Duración en segundos según ffprobe (None si no se puede leer)"""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", path],
+        check=True, capture_output=True, text=True
+    )
+    duration = json.loads(result.stdout).get("format", {}).get("duration")
+    return float(duration) if duration else None
+
+
+def remux(path):
+    """Cambia el contenedor a mp4 sin recodificar (Telegram solo reproduce mp4 en línea)"""
+    out = f"{os.path.splitext(path)[0]}_remux.mp4"
+    run_ffmpeg(["-i", path, "-map", "0", "-c", "copy", "-movflags", "+faststart"], out)
+    os.remove(path)
+    return out
+
+
+def transcode(path, video_kbps):
+    """Recodifica a H.264/AAC con el bitrate indicado"""
+    out = f"{os.path.splitext(path)[0]}_tc.mp4"
+    run_ffmpeg([
+        "-i", path,
+        "-c:v", "libx264", "-preset", "veryfast",
+        "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k",
+        "-c:a", "aac", "-b:a", f"{AUDIO_BITRATE}k",
+        "-movflags", "+faststart",
+    ], out)
+    os.remove(path)
+    return out
+
+
+def split(path, duration, limit, depth=0):
+    """Corta el video en partes consecutivas (sin recodificar) que quepan en el límite"""
+    size = os.path.getsize(path)
+    parts = math.ceil(size / (limit * SIZE_MARGIN))
+    root = os.path.splitext(path)[0]
+    pattern = f"{root}_part%03d.mp4"
+
+    def outputs():
+        # Los cortes caen en keyframes, así que puede salir alguna parte más
+        return [pattern % i for i in range(parts * 2) if os.path.exists(pattern % i)]
+
+    try:
+        run_ffmpeg([
+            "-i", path, "-map", "0", "-c", "copy",
+            "-f", "segment", "-segment_time", f"{duration / parts:.2f}",
+            "-reset_timestamps", "1", "-segment_format_options", "movflags=+faststart",
+        ], pattern)
+    except Exception:
+        for part in outputs():
+            os.remove(part)
+        raise
+    os.remove(path)
+
+    # Los cortes caen en keyframes: una parte puede seguir pasándose y se vuelve a cortar
+    result = []
+    for part in outputs():
+        if os.path.getsize(part) > limit and depth < MAX_SPLIT_DEPTH:
+            try:
+                part_duration = get_duration(part)
+                if part_duration:
+                    result.extend(split(part, part_duration, limit, depth + 1))
+                    continue
+            except Exception as e:
+                # split solo borra su entrada si terminó bien: la parte sigue ahí
+                print(f"Error recortando {part}: {e}")
+        result.append(part)
+    return result
+
+
+def fit_to_limit(path, limit=MAX_UPLOAD_SIZE):
+    """
+    Deja el video listo para subir: lo pasa a mp4 si hace falta y, si supera
+    el límite, lo recodifica a un bitrate que quepa o, si la calidad quedaría
+    demasiado baja, lo divide en partes. Devuelve la lista de archivos finales
+    """
+    try:
+        if not path.endswith(".mp4"):
+            path = remux(path)
+
+        if os.path.getsize(path) <= limit:
+            return [path]
+
+        duration = get_duration(path)
+        if not duration:
+            return [path]
+
+        # Bitrate de video que cabe en el límite descontando el audio
+        total_kbps = limit * SIZE_MARGIN * 8 / 1000 / duration
+        video_kbps = int(total_kbps - AUDIO_BITRATE)
+        if video_kbps >= MIN_VIDEO_BITRATE:
+            path = transcode(path, video_kbps)
+            if os.path.getsize(path) <= limit:
+                return [path]
+
+        return split(path, duration, limit)
+
+    except Exception as e:
+        # Cada paso solo borra su entrada si terminó bien: path sigue siendo válido
+        print(f"Error procesando {path}: {e}")
+        return [path]
+
+
+async def prepare_video(path):
+    """Ejecuta fit_to_limit en el pool de procesos (sin bloquear el bot)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(process_pool, fit_to_limit, path)
+
+
+# ---------- IMÁGENES ----------
+
+def dhash(img, size=8):
+    """Hash perceptual (diferencia entre píxeles vecinos): casi igual si las imágenes se parecen"""
+    small = img.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = bits << 1 | (left > right)
+    return bits
+
+
+def to_rgb(img):
+    """Quita la transparencia sobre fondo blanco (JPEG no la admite)"""
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def prepare_photo(path):
+    """
+    Deja una imagen lista para enviarse como foto. Descarta lo que no es una
+    foto (iconos, banners) mirando solo la cabecera; pasa WebP/PNG a JPEG y
+    reduce las que superan los límites de Telegram. Devuelve (ruta, hash
+    perceptual), o (None, None) si se descarta
+    """
+    try:
+        with Image.open(path) as img:
+            # Hasta aquí solo se ha leído la cabecera
+            width, height = img.size
+            if min(width, height) < PHOTO_MIN_SIDE or max(width, height) / min(width, height) > MAX_PHOTO_RATIO:
+                os.remove(path)
+                return None, None
+
+            fits = (
+                img.format == "JPEG"
+                and max(width, height) <= PHOTO_MAX_SIDE
+                and os.path.getsize(path) <= PHOTO_MAX_BYTES
+            )
+            # En JPEG, decodificar ya a escala reducida cuando sobra resolución
+            img.draft("RGB", (PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+            img.load()
+            image_hash = dhash(img)
+            if fits:
+                return path, image_hash
+
+            img = to_rgb(img)
+            img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), Image.Resampling.LANCZOS)
+            out = f"{os.path.splitext(path)[0]}_tg.jpg"
+            quality = PHOTO_JPEG_QUALITY
+            img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+            while os.path.getsize(out) > PHOTO_MAX_BYTES and quality > 50:
+                quality -= 10
+                img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+
+        os.remove(path)
+        return out, image_hash
+
+    except UnidentifiedImageError:
+        # No es una imagen (p. ej. una página de error guardada como .jpg)
+        os.remove(path)
+        return None, None
+    except Exception as e:
+        print(f"Error procesando imagen {path}: {e}")
+        return path, None
+
+
+async def prepare_image(path):
+    """Ejecuta prepare_photo en el pool de procesos de imágenes"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_pool, prepare_photo, path)
\ No newline at end of file
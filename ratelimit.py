@@ -0,0 +1,215 @@
+import asyncio
+import re
+import time
+from config import (
+    UPSTREAM_RATE, UPSTREAM_MIN_RATE, UPSTREAM_BURST, UPSTREAM_MAX_WAIT,
+    BREAKER_FAILURES, BREAKER_COOLDOWN, BREAKER_MAX_COOLDOWN, UPSTREAM_SYNC_INTERVAL
+)
+from state_store import state_store
+from metrics import UPSTREAM_RATE as RATE_GAUGE, UPSTREAM_BREAKER, UPSTREAM_REJECTED
+
+# Textos de error (yt-dlp, TikTokApi) que indican que la plataforma nos está limitando
+THROTTLED_RE = re.compile(
+    r"\b(?:429|403)\b|too many requests|forbidden|rate[- ]limit|login required"
+    r"|please wait a few minutes|captcha|emptyresponse",
+    re.IGNORECASE
+)
+
+# Y los que indican que no responde (cuentan para el cortacircuitos, no para el ritmo)
+FAILED_RE = re.compile(
+    r"\b(?:502|503|504)\b|timed out|timeout|connection (?:reset|refused|aborted)|remote end closed",
+    re.IGNORECASE
+)
+
+
+class UpstreamUnavailable(Exception):
+    """La plataforma está limitando o caída: se rechaza sin llegar a pedirle nada"""
+
+    def __init__(self, platform, retry_after):
+        self.platform = platform
+        self.retry_after = max(1, int(retry_after))
+        super().__init__(f"{platform} no está disponible ahora mismo (reintentar en {self.retry_after} s)")
+
+
+def classify(exc):
+    """'throttled', 'failed' o None si el error no es culpa de la plataforma"""
+    text = f"{type(exc).__name__} {exc}"
+    if THROTTLED_RE.search(text):
+        return "throttled"
+    if isinstance(exc, (TimeoutError, ConnectionError)) or FAILED_RE.search(text):
+        return "failed"
+    return None
+
+
+class PlatformLimiter:
+    """
+    Cubeta de fichas con ritmo adaptativo (mitad con cada 429/403, sube poco a
+    poco con cada acierto) y cortacircuitos para una plataforma. El estado se
+    publica en el state_store para que lo respeten las demás instancias
+    """
+
+    def __init__(self, platform, rate, min_rate, burst, max_wait, failures, cooldown, max_cooldown):
+        self.platform = platform
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self.max_wait = max_wait
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.rate = rate
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.failures = 0  # fallos seguidos
+        self.trips = 0  # aperturas seguidas sin un acierto en medio
+        self.open_until = 0  # time.time(), comparable entre procesos
+        self.probing_since = None  # petición de prueba en curso (circuito medio abierto)
+        self.updated_at = 0
+        self.synced_at = 0
+        self._report()
+
+    def state(self):
+        """'open', 'half_open' o 'closed'"""
+        if time.time() < self.open_until:
+            return "open"
+        return "half_open" if self.trips else "closed"
+
+    def retry_after(self):
+        return max(self.open_until - time.time(), 1)
+
+    def probing(self):
+        # Una prueba que nunca informó (tarea cancelada) no bloquea más de un cooldown
+        return self.probing_since is not None and time.monotonic() - self.probing_since < self.cooldown
+
+    def available(self):
+        """Si una petición nueva tiene posibilidades (sin consumir ficha)"""
+        state = self.state()
+        return state == "closed" or (state == "half_open" and not self.probing())
+
+    async def sync(self):
+        """Adopta el estado de otra instancia si es más reciente que el propio"""
+        now = time.monotonic()
+        if now - self.synced_at < UPSTREAM_SYNC_INTERVAL:
+            return
+        self.synced_at = now
+        try:
+            shared = await state_store.get_upstream(self.platform)
+        except Exception as e:
+            print(f"Error leyendo el estado de {self.platform}: {e}")
+            return
+        if shared and shared["updated_at"] > self.updated_at:
+            self.rate = min(max(shared["rate"], self.min_rate), self.max_rate)
+            self.open_until = shared["open_until"]
+            self.trips = shared["trips"]
+            self.updated_at = shared["updated_at"]
+            self._report()
+
+    async def acquire(self):
+        """
+        Espera turno para una petición a la plataforma. Lanza UpstreamUnavailable
+        si el circuito está abierto o la espera superaría max_wait
+        """
+        await self.sync()
+        self._report()
+        state = self.state()
+        if state == "open" or (state == "half_open" and self.probing()):
+            UPSTREAM_REJECTED.labels(platform=self.platform).inc()
+            raise UpstreamUnavailable(self.platform, self.retry_after())
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+        if wait > self.max_wait:
+            UPSTREAM_REJECTED.labels(platform=self.platform).inc()
+            raise UpstreamUnavailable(self.platform, wait)
+
+        # La ficha se reserva ya (puede quedar en negativo): los siguientes esperan detrás
+        self.tokens -= 1
+        if state == "half_open":
+            self.probing_since = time.monotonic()
+        if wait:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.probing_since = None
+                raise
+
+    async def record(self, outcome):
+        """Resultado de una petición: 'ok', 'throttled', 'failed' o None (ver classify)"""
+        self.probing_since = None
+        if outcome is None:
+            # Contenido privado, borrado...: no dice nada de la plataforma
+            return
+
+        if outcome == "ok":
+            if self.failures == 0 and self.trips == 0 and self.rate >= self.max_rate:
+                return
+            self.failures = 0
+            self.trips = 0
+            self.open_until = 0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+        else:
+            self.failures += 1
+            if outcome == "throttled":
+                self.rate = max(self.min_rate, self.rate / 2)
+            # Medio abierto: un solo fallo lo vuelve a abrir
+            if self.failures >= self.threshold or self.trips:
+                self.trips += 1
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** (self.trips - 1))
+                self.open_until = time.time() + cooldown
+                self.failures = 0
+                print(f"🚫 {self.platform}: circuito abierto {cooldown} s")
+
+        self.updated_at = time.time()
+        self._report()
+        try:
+            await state_store.put_upstream(self.platform, {
+                "rate": self.rate,
+                "open_until": self.open_until,
+                "trips": self.trips,
+                "updated_at": self.updated_at,
+            })
+        except Exception as e:
+            print(f"Error guardando el estado de {self.platform}: {e}")
+
+    def _report(self):
+        RATE_GAUGE.labels(platform=self.platform).set(self.rate)
+        UPSTREAM_BREAKER.labels(platform=self.platform).set(
+            {"closed": 0, "half_open": 1, "open": 2}[self.state()]
+        )
+
+
+class UpstreamLimiters:
+    """Un limitador por plataforma, compartido por todos los trabajadores de descarga"""
+
+    def __init__(self, rates, min_rate, burst, max_wait, failures, cooldown, max_cooldown):
+        self.limiters = {
+            platform: PlatformLimiter(platform, rate, min_rate, burst, max_wait, failures, cooldown, max_cooldown)
+            for platform, rate in rates.items()
+        }
+
+    def available(self, platform):
+        limiter = self.limiters.get(platform)
+        return limiter is None or limiter.available()
+
+    def retry_after(self, platform):
+        limiter = self.limiters.get(platform)
+        return limiter.retry_after() if limiter else 1
+
+    async def acquire(self, platform):
+        limiter = self.limiters.get(platform)
+        if limiter is not None:
+            await limiter.acquire()
+
+    async def record(self, platform, outcome):
+        limiter = self.limiters.get(platform)
+        if limiter is not None:
+            await limiter.record(outcome)
+
+
+upstream = UpstreamLimiters(
+    UPSTREAM_RATE, UPSTREAM_MIN_RATE, UPSTREAM_BURST, UPSTREAM_MAX_WAIT,
+    BREAKER_FAILURES, BREAKER_COOLDOWN, BREAKER_MAX_COOLDOWN
+)
\ No newline at end of file
@@ -0,0 +1,184 @@
+import asyncio
+from collections import OrderedDict, deque
+from config import DOWNLOAD_WORKERS, MAX_JOBS_PER_USER, MAX_QUEUE_SIZE
+from workspace import workspace
+from metrics import QUEUE_DEPTH, ACTIVE_WORKERS
+
+# Como mucho tantas ediciones de "posición en cola" por segundo entre todos los trabajos
+POSITION_EDITS_PER_SECOND = 10
+
+
+class QueueFullError(Exception):
+    """La cola de descargas está llena"""
+
+
+class Job:
+    def __init__(self, user_id, func, args, on_position):
+        self.user_id = user_id
+        self.func = func
+        self.args = args
+        self.on_position = on_position
+        self.position = None
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+
+
+class DownloadScheduler:
+    """
+    Cola de descargas con un número fijo de workers, límite de trabajos
+    simultáneos por usuario y reparto round-robin entre usuarios
+    """
+
+    def __init__(self, workers=4, per_user=2, max_queue=50, has_room=None, notify_rate=POSITION_EDITS_PER_SECOND):
+        self.workers = workers
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.has_room = has_room  # comprobación de recursos (p. ej. disco) antes de admitir
+        self.notify_rate = notify_rate
+        self._outdated = OrderedDict()  # trabajos con la posición por avisar (Job -> None)
+        self._notifier = None
+        self._pending = OrderedDict()  # user_id -> deque de Job en espera
+        self._active = {}  # user_id -> trabajos en ejecución
+        self._active_total = 0
+
+    @property
+    def queue_depth(self):
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    @property
+    def active(self):
+        return self._active_total
+
+    async def submit(self, user_id, func, *args, on_position=None):
+        """
+        Encola func(*args) para el usuario y espera su resultado.
+        on_position(n) se llama cada vez que cambia la posición en la cola,
+        y con 0 cuando el trabajo sale de la cola y empieza
+        """
+        if self.queue_depth >= self.max_queue:
+            raise QueueFullError("Cola de descargas llena")
+        if self.has_room and not self.has_room():
+            raise QueueFullError("Sin espacio en disco para más descargas")
+
+        job = Job(user_id, func, args, on_position)
+        self._pending.setdefault(user_id, deque()).append(job)
+        self._dispatch()
+
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            # El que esperaba se canceló: sacar de la cola o detener el trabajo
+            if job.task is None:
+                self._remove_pending(job)
+                self._dispatch()
+            else:
+                job.task.cancel()
+            raise
+
+    def _remove_pending(self, job):
+        jobs = self._pending.get(job.user_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self._pending[job.user_id]
+        self._outdated.pop(job, None)
+
+    def _next_job(self):
+        """Siguiente trabajo en orden round-robin respetando el límite por usuario"""
+        for user_id in list(self._pending):
+            if self._active.get(user_id, 0) >= self.per_user:
+                continue
+            jobs = self._pending.pop(user_id)
+            job = jobs.popleft()
+            # El usuario pasa al final de la ronda
+            if jobs:
+                self._pending[user_id] = jobs
+            return job
+        return None
+
+    def _dispatch(self):
+        while self._active_total < self.workers:
+            job = self._next_job()
+            if job is None:
+                break
+            self._active[job.user_id] = self._active.get(job.user_id, 0) + 1
+            self._active_total += 1
+            job.task = asyncio.create_task(self._run(job))
+            if job.position is not None and job.on_position:
+                job.position = 0
+                asyncio.create_task(self._notify(job, 0))
+        self._update_positions()
+        QUEUE_DEPTH.set(self.queue_depth)
+        ACTIVE_WORKERS.set(self._active_total)
+
+    async def _run(self, job):
+        try:
+            result = await job.func(*job.args)
+            if not job.future.done():
+                job.future.set_result(result)
+        except BaseException as e:
+            if not job.future.done():
+                if isinstance(e, asyncio.CancelledError):
+                    job.future.cancel()
+                else:
+                    job.future.set_exception(e)
+        finally:
+            self._active[job.user_id] -= 1
+            if not self._active[job.user_id]:
+                del self._active[job.user_id]
+            self._active_total -= 1
+            self._dispatch()
+
+    def _update_positions(self):
+        """Recalcula la posición de cada trabajo en espera simulando las rondas"""
+        queues = [list(jobs) for jobs in self._pending.values()]
+        position = 0
+        depth = 0
+        while queues:
+            for jobs in queues:
+                job = jobs[depth] if depth < len(jobs) else None
+                if job is None:
+                    continue
+                position += 1
+                if job.position != position:
+                    job.position = position
+                    if job.on_position:
+                        self._outdated[job] = None
+            depth += 1
+            queues = [jobs for jobs in queues if depth < len(jobs)]
+
+        if self._outdated and self._notifier is None:
+            self._notifier = asyncio.create_task(self._notify_positions())
+
+    async def _notify_positions(self):
+        """
+        Avisa de las posiciones cambiadas a ritmo limitado (Telegram corta las
+        ráfagas de ediciones). Un trabajo que cambia varias veces antes de su
+        turno recibe un solo aviso, con la última posición
+        """
+        try:
+            while self._outdated:
+                job, _ = self._outdated.popitem(last=False)
+                if job.task is not None or not job.position:
+                    # Ya empezó (el aviso de inicio va aparte)
+                    continue
+                retry_after = await self._notify(job, job.position)
+                await asyncio.sleep(max(retry_after, 1 / self.notify_rate))
+        finally:
+            self._notifier = None
+
+    async def _notify(self, job, position):
+        """Devuelve los segundos que pide esperar Telegram (0 si no hay que frenar)"""
+        # Aviso obsoleto: la posición ya cambió
+        if job.position != position:
+            return 0
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            print(f"Error notificando posición en cola: {e}")
+            # RetryAfter: frenar también los avisos de los demás trabajos
+            return getattr(e, "retry_after", 0)
+        return 0
+
+
+scheduler = DownloadScheduler(DOWNLOAD_WORKERS, MAX_JOBS_PER_USER, MAX_QUEUE_SIZE, workspace.has_room)
\ No newline at end of file
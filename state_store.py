@@ -0,0 +1,95 @@
+import json
+import time
+import secrets
+from config import STATE_BACKEND, PENDING_REQUEST_TTL
+from database import (
+    save_pending_request, claim_pending_request, delete_pending_request,
+    save_upstream_state, get_upstream_state
+)
+
+
+def new_token():
+    """Token corto para callback_data (8 caracteres, sin ':')"""
+    return secrets.token_urlsafe(6)
+
+
+class SQLiteStateStore:
+    """
+    Estado en history.db: cualquier proceso que comparta la base de datos
+    puede atender el botón que pulsó el usuario
+    """
+
+    async def put(self, data):
+        token = new_token()
+        await save_pending_request(token, json.dumps(data))
+        return token
+
+    async def claim(self, token):
+        """Devuelve los datos y los borra (solo un proceso los obtiene), o None"""
+        data = await claim_pending_request(token)
+        return json.loads(data) if data else None
+
+    async def discard(self, token):
+        await delete_pending_request(token)
+
+    async def request_cancel(self, token):
+        """Pide cancelar la descarga del token a la instancia que la tenga"""
+        await save_pending_request(f"stop:{token}", "true")
+
+    async def cancel_requested(self, token):
+        return await claim_pending_request(f"stop:{token}") is not None
+
+    async def put_upstream(self, platform, data):
+        """Publica el estado del limitador de una plataforma para las demás instancias"""
+        save_upstream_state(platform, json.dumps(data), data["updated_at"])
+
+    async def get_upstream(self, platform):
+        row = await get_upstream_state(platform)
+        return json.loads(row[0]) if row else None
+
+
+class MemoryStateStore:
+    """Estado en memoria, para una sola instancia del bot"""
+
+    def __init__(self):
+        self._data = {}
+
+    async def put(self, data):
+        now = time.time()
+        # Limpiar las que nadie llegó a usar
+        for token, (created_at, _) in list(self._data.items()):
+            if now - created_at > PENDING_REQUEST_TTL:
+                del self._data[token]
+        token = new_token()
+        self._data[token] = (now, data)
+        return token
+
+    async def claim(self, token):
+        entry = self._data.pop(token, None)
+        if entry is None or time.time() - entry[0] > PENDING_REQUEST_TTL:
+            return None
+        return entry[1]
+
+    async def discard(self, token):
+        self._data.pop(token, None)
+
+    async def request_cancel(self, token):
+        self._data[f"stop:{token}"] = (time.time(), True)
+
+    async def cancel_requested(self, token):
+        return await self.claim(f"stop:{token}") is not None
+
+    async def put_upstream(self, platform, data):
+        self._data[f"upstream:{platform}"] = (float("inf"), data)
+
+    async def get_upstream(self, platform):
+        entry = self._data.get(f"upstream:{platform}")
+        return entry[1] if entry else None
+
+
+BACKENDS = {
+    "sqlite": SQLiteStateStore,
+    "memory": MemoryStateStore,
+}
+
+state_store = BACKENDS[STATE_BACKEND]()
\ No newline at end of file
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from config import TIKTOK_SESSIONS, TIKTOK_SESSION_MAX_IDLE, TIKTOK_SESSION_MAX_FAILURES
+
+
+class TikTokSession:
+    def __init__(self):
+        self.api = None
+        self.created_at = 0
+        self.last_used = 0
+        self.failures = 0
+
+
+class TikTokSessionPool:
+    """
+    Conjunto de sesiones de TikTokApi independientes. Cada petición toma
+    una sesión libre; las que fallan o llevan mucho tiempo sin usarse se
+    sustituyen por una nueva
+    """
+
+    def __init__(self, size=2, max_idle=600, max_failures=3):
+        self.size = size
+        self.max_idle = max_idle
+        self.max_failures = max_failures
+        self._sessions = None
+        self._maintenance = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """Crea todas las sesiones en paralelo (las que fallen se reintentan al usarse)"""
+        async with self._lock:
+            if self._sessions is not None:
+                return
+            slots = [TikTokSession() for _ in range(self.size)]
+            await asyncio.gather(*(self._open(slot) for slot in slots), return_exceptions=True)
+            self._sessions = asyncio.Queue()
+            for slot in slots:
+                self._sessions.put_nowait(slot)
+            self._maintenance = asyncio.create_task(self._maintain())
+
+    async def stop(self):
+        async with self._lock:
+            if self._sessions is None:
+                return
+            self._maintenance.cancel()
+            while not self._sessions.empty():
+                await self._close(self._sessions.get_nowait())
+            self._sessions = None
+
+    async def _open(self, slot):
+        # Importado al primer uso: TikTokApi arrastra Playwright y tarda en cargar
+        from TikTokApi import TikTokApi
+        api = TikTokApi()
+        try:
+            await api.create_sessions(num_sessions=1, sleep_after=3, headless=True)
+        except Exception as e:
+            print(f"Error al inicializar TikTokApi: {e}")
+            await self._close_api(api)
+            raise
+        slot.api = api
+        slot.created_at = slot.last_used = time.monotonic()
+        slot.failures = 0
+
+    async def _close_api(self, api):
+        try:
+            await api.close_sessions()
+            await api.stop_playwright()
+        except Exception:
+            pass
+
+    async def _close(self, slot):
+        if slot.api is not None:
+            await self._close_api(slot.api)
+            slot.api = None
+
+    async def _healthy(self, slot):
+        """Sonda rápida: la página de la sesión sigue viva y responde"""
+        if slot.api is None or not slot.api.sessions:
+            return False
+        if time.monotonic() - slot.last_used > self.max_idle:
+            return False
+        try:
+            page = slot.api.sessions[0].page
+            await asyncio.wait_for(page.evaluate("() => true"), timeout=5)
+            return True
+        except Exception:
+            return False
+
+    async def _maintain(self):
+        """Revisa periódicamente las sesiones libres y renueva las caducadas"""
+        while True:
+            await asyncio.sleep(max(self.max_idle / 2, 30))
+            for _ in range(self._sessions.qsize()):
+                slot = self._sessions.get_nowait()
+                try:
+                    if not await self._healthy(slot):
+                        await self._close(slot)
+                        await self._open(slot)
+                except Exception:
+                    pass
+                finally:
+                    self._sessions.put_nowait(slot)
+
+    @asynccontextmanager
+    async def lease(self):
+        """Presta una sesión sana de TikTokApi (la renueva si hace falta)"""
+        if self._sessions is None:
+            await self.start()
+
+        slot = await self._sessions.get()
+        try:
+            if not await self._healthy(slot):
+                await self._close(slot)
+                await self._open(slot)
+            try:
+                yield slot.api
+                slot.failures = 0
+            except Exception:
+                slot.failures += 1
+                raise
+            finally:
+                slot.last_used = time.monotonic()
+        finally:
+            # Rotar sesiones que fallan repetidamente
+            if slot.failures >= self.max_failures:
+                await self._close(slot)
+            self._sessions.put_nowait(slot)
+
+
+tiktok_pool = TikTokSessionPool(TIKTOK_SESSIONS, TIKTOK_SESSION_MAX_IDLE, TIKTOK_SESSION_MAX_FAILURES)
\ No newline at end of file
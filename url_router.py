@@ -0,0 +1,179 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+from urllib.parse import urlparse, parse_qs
+from config import SHORT_LINK_CACHE_TTL, SHORT_LINK_CACHE_SIZE
+from http_client import get_client
+
+# Cualquier cosa con pinta de URL dentro de un mensaje (con o sin esquema)
+LINK_RE = re.compile(r'(?:https?://)?(?:[\w-]+\.)+[a-z]{2,}(?::\d+)?(?:/[^\s<>"]*)?', re.IGNORECASE)
+
+# El identificador tiene que terminar ahí: "youtu.be/<11 caracteres>basura" no es válido
+END = r'(?=$|/)'
+YOUTUBE_ID = r'([\w-]{11})(?=$|[/?#&])'
+
+# Por dominio: (patrón sobre la ruta, tipo de contenido)
+ROUTES = {
+    "tiktok.com": [
+        (re.compile(rf'^/@([\w.-]*)/video/(\d+){END}'), "video"),
+        (re.compile(rf'^/@([\w.-]*)/photo/(\d+){END}'), "album"),
+        (re.compile(r'^/()v/(\d+)(?=$|/|\.html)'), "video"),
+        (re.compile(rf'^/t/(\w+){END}'), "short"),
+    ],
+    "vm.tiktok.com": [(re.compile(rf'^/(\w+){END}'), "short")],
+    "vt.tiktok.com": [(re.compile(rf'^/(\w+){END}'), "short")],
+    "instagram.com": [
+        (re.compile(rf'^/(?:[\w.]+/)?p/([\w-]+){END}'), "post"),
+        (re.compile(rf'^/(?:[\w.]+/)?(?:reel|reels|tv)/([\w-]+){END}'), "reel"),
+        (re.compile(rf'^/stories/highlights/()(\d+){END}'), "highlight"),
+        (re.compile(rf'^/stories/([\w.]+)/(\d+){END}'), "story"),
+        (re.compile(r'^/stories/([\w.]+)()/?$'), "stories"),
+    ],
+    "youtube.com": [
+        (re.compile(rf'^/(?:shorts|embed|live|v)/{YOUTUBE_ID}'), "video"),
+        (re.compile(rf'^/(@[\w.-]+|(?:channel|c|user)/[\w.-]+){END}'), "channel"),
+    ],
+    "youtube-nocookie.com": [(re.compile(rf'^/embed/{YOUTUBE_ID}'), "video")],
+    "youtu.be": [(re.compile(rf'^/{YOUTUBE_ID}'), "video")],
+}
+
+PLATFORMS = {
+    "tiktok.com": "TikTok",
+    "vm.tiktok.com": "TikTok",
+    "vt.tiktok.com": "TikTok",
+    "instagram.com": "Instagram",
+    "youtube.com": "YouTube",
+    "youtube-nocookie.com": "YouTube",
+    "youtu.be": "YouTube",
+}
+
+# Enlaces cortos ya resueltos: URL -> (momento, URL final)
+short_links = OrderedDict()
+
+
+class Link(NamedTuple):
+    platform: str  # "TikTok", "Instagram" o "YouTube"
+    # "video", "album" (fotos de TikTok), "post", "reel", "story", "stories", "highlight",
+    # "playlist", "channel" o "short" (sin resolver)
+    kind: str
+    content_id: str
+    url: str  # URL canónica (o la original si es un enlace corto)
+
+    @property
+    def key(self):
+        """Identifica el contenido sin importar cómo se escribió el link"""
+        return f"{self.platform.lower()}:{self.content_id}"
+
+
+def normalize_host(host):
+    host = host.lower().split(":")[0]
+    for prefix in ("www.", "m.", "mobile.", "music."):
+        if host.startswith(prefix):
+            return host[len(prefix):]
+    return host
+
+
+def canonical_url(platform, kind, content_id, user=""):
+    if platform == "TikTok":
+        # TikTokApi y yt-dlp necesitan la forma /@usuario/...; el usuario puede ir vacío
+        return f"https://www.tiktok.com/@{user}/{'photo' if kind == 'album' else 'video'}/{content_id}"
+    if platform == "Instagram":
+        if kind == "story":
+            return f"https://www.instagram.com/stories/{user}/{content_id}/"
+        if kind == "stories":
+            return f"https://www.instagram.com/stories/{user}/"
+        if kind == "highlight":
+            return f"https://www.instagram.com/stories/highlights/{content_id}/"
+        return f"https://www.instagram.com/{'p' if kind == 'post' else 'reel'}/{content_id}/"
+    if kind == "playlist":
+        return f"https://www.youtube.com/playlist?list={content_id}"
+    if kind == "channel":
+        return f"https://www.youtube.com/{user}"
+    return f"https://www.youtube.com/watch?v={content_id}"
+
+
+def parse_link(url):
+    """Clasifica una URL sin hacer peticiones; None si no es un contenido soportado"""
+    url = url.strip()
+    parsed = urlparse(url if "://" in url else f"https://{url}")
+    host = normalize_host(parsed.netloc)
+    platform = PLATFORMS.get(host)
+    if platform is None:
+        return None
+
+    if host == "youtube.com" and parsed.path in ("/watch", "/playlist"):
+        query = parse_qs(parsed.query)
+        video_id = query.get("v", [""])[0]
+        if parsed.path == "/watch" and re.fullmatch(YOUTUBE_ID, video_id):
+            return Link(platform, "video", video_id, canonical_url(platform, "video", video_id))
+        # Listas (como antes, yt-dlp las baja enteras: noplaylist=False)
+        playlist_id = query.get("list", [""])[0]
+        if re.fullmatch(r'[\w-]+', playlist_id):
+            return Link(
+                platform, "playlist", f"playlist:{playlist_id}",
+                canonical_url(platform, "playlist", playlist_id)
+            )
+        return None
+
+    for pattern, kind in ROUTES[host]:
+        match = pattern.match(parsed.path)
+        if not match:
+            continue
+        if kind == "short":
+            return Link(platform, kind, f"short:{match.group(1)}", url)
+        if kind == "channel":
+            return Link(platform, kind, f"channel:{match.group(1)}", canonical_url(platform, kind, "", match.group(1)))
+        user, content_id = match.groups() if pattern.groups == 2 else ("", match.group(1))
+        url = canonical_url(platform, kind, content_id, user)
+        if kind in ("story", "stories", "highlight"):
+            # Los ids de historias son números y podrían coincidir con otro tipo
+            content_id = f"{kind}:{content_id or user}"
+        return Link(platform, kind, content_id, url)
+    return None
+
+
+async def resolve(link):
+    """Sigue la redirección de un enlace corto (HEAD, con caché); el resto se devuelve tal cual"""
+    if link is None or link.kind != "short":
+        return link
+
+    cached = short_links.get(link.url)
+    if cached and time.monotonic() - cached[0] < SHORT_LINK_CACHE_TTL:
+        short_links.move_to_end(link.url)
+        final = cached[1]
+    else:
+        url = link.url if "://" in link.url else f"https://{link.url}"
+        try:
+            response = await get_client().head(url)
+            final = str(response.url)
+        except Exception as e:
+            print(f"Error resolviendo enlace corto {url}: {e}")
+            return None
+        short_links[link.url] = (time.monotonic(), final)
+        if len(short_links) > SHORT_LINK_CACHE_SIZE:
+            short_links.popitem(last=False)
+
+    resolved = parse_link(final)
+    # Un enlace corto que lleva a otro enlace corto no se sigue más
+    return resolved if resolved and resolved.kind != "short" else None
+
+
+def find_links(text):
+    """Todos los links soportados de un mensaje, sin repetir y en orden"""
+    links = {}
+    for match in LINK_RE.finditer(text or ""):
+        link = parse_link(match.group(0).rstrip(".,;:!?)]}»"))
+        if link and link.key not in links:
+            links[link.key] = link
+    return list(links.values())
+
+
+async def route(text):
+    """find_links + resolución de enlaces cortos (quitando duplicados tras resolver)"""
+    links = {}
+    for link in await asyncio.gather(*(resolve(link) for link in find_links(text))):
+        if link and link.key not in links:
+            links[link.key] = link
+    return list(links.values())
\ No newline at end of file
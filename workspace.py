@@ -0,0 +1,148 @@
+import asyncio
+import os
+import shutil
+import time
+import uuid
+from config import (
+    WORKSPACE_DIR, WORKSPACE_TMPFS, WORKSPACE_TMPFS_MAX, WORKSPACE_QUOTA, WORKSPACE_MIN_FREE,
+    WORKSPACE_MAX_AGE, JANITOR_INTERVAL
+)
+
+
+class Workspace:
+    """
+    Carpetas de trabajo de las descargas: cada una tiene la suya (en tmpfs si
+    es pequeña y hay uno configurado), con una cuota de disco común y un
+    limpiador que borra lo que quede abandonado
+    """
+
+    def __init__(self, root="media", tmpfs_root="", tmpfs_max=0, quota=0, min_free=0,
+                 max_age=3600, interval=300):
+        self.root = root
+        self.tmpfs_root = tmpfs_root
+        self.tmpfs_max = tmpfs_max
+        self.quota = quota
+        self.min_free = min_free
+        self.max_age = max_age
+        self.interval = interval
+        self._usage = 0
+        self._usage_at = 0
+        self._counting = None  # recuento en curso (en un hilo)
+        self._janitor = None
+
+    def roots(self):
+        return [root for root in (self.root, self.tmpfs_root) if root]
+
+    def create(self, expected_size=None):
+        """Crea una carpeta vacía para una descarga y devuelve su ruta"""
+        small = expected_size is not None and expected_size <= self.tmpfs_max
+        root = self.tmpfs_root if self.tmpfs_root and small else self.root
+        path = os.path.join(root, uuid.uuid4().hex[:12])
+        os.makedirs(path)
+        return path
+
+    def remove(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+
+    def usage(self):
+        """
+        Bytes ocupados por todas las descargas según el último recuento. Si tiene
+        más de 2 s se lanza otro en un hilo: el bucle de eventos no recorre el disco
+        """
+        now = time.monotonic()
+        if now - self._usage_at > 2 and self._counting is None:
+            self._usage_at = now
+            self._counting = asyncio.get_running_loop().run_in_executor(None, self._count)
+            self._counting.add_done_callback(self._counted)
+        return self._usage
+
+    def _count(self):
+        return sum(size for _, size, _ in self._scan())
+
+    def _counted(self, future):
+        self._counting = None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(f"Error midiendo la carpeta de trabajo: {future.exception()}")
+            return
+        self._usage = future.result()
+
+    def has_room(self):
+        """Si se pueden empezar descargas nuevas (cuota y espacio libre en disco)"""
+        if self.quota and self.usage() >= self.quota:
+            return False
+        if self.min_free:
+            os.makedirs(self.root, exist_ok=True)
+            if shutil.disk_usage(self.root).free < self.min_free:
+                return False
+        return True
+
+    def _scan(self):
+        """(ruta, bytes, última modificación) de cada entrada de primer nivel"""
+        for root in self.roots():
+            if not os.path.isdir(root):
+                continue
+            for entry in os.scandir(root):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        size, mtime = 0, entry.stat().st_mtime
+                        for dirpath, _, filenames in os.walk(entry.path):
+                            for name in filenames:
+                                st = os.stat(os.path.join(dirpath, name))
+                                size += st.st_size
+                                mtime = max(mtime, st.st_mtime)
+                    else:
+                        st = entry.stat()
+                        size, mtime = st.st_size, st.st_mtime
+                except FileNotFoundError:
+                    continue
+                yield entry.path, size, mtime
+
+    def clean(self):
+        """
+        Borra carpetas y archivos sin cambios desde hace max_age segundos
+        (descargas abandonadas, .part de caídas, restos de versiones anteriores)
+        """
+        cutoff = time.time() - self.max_age
+        freed = 0
+        for path, size, mtime in list(self._scan()):
+            if mtime >= cutoff:
+                continue
+            if os.path.isdir(path):
+                self.remove(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            freed += size
+        self._usage_at = 0
+        return freed
+
+    async def start(self):
+        if self._janitor is None:
+            for root in self.roots():
+                os.makedirs(root, exist_ok=True)
+            # Primer recuento ya, para que la cuota cuente desde la primera descarga
+            self.usage()
+            self._janitor = asyncio.create_task(self._run_janitor())
+
+    async def stop(self):
+        if self._janitor is not None:
+            self._janitor.cancel()
+            self._janitor = None
+
+    async def _run_janitor(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                freed = await loop.run_in_executor(None, self.clean)
+                if freed:
+                    print(f"🧹 Limpieza de media: {freed / (1024 * 1024):.1f} MB liberados")
+            except Exception as e:
+                print(f"Error limpiando la carpeta de trabajo: {e}")
+            await asyncio.sleep(self.interval)
+
+
+workspace = Workspace(
+    WORKSPACE_DIR, WORKSPACE_TMPFS, WORKSPACE_TMPFS_MAX, WORKSPACE_QUOTA, WORKSPACE_MIN_FREE,
+    WORKSPACE_MAX_AGE, JANITOR_INTERVAL
+)
\ No newline at end of file